@@ -1,18 +1,41 @@
 import os
 import json
+import math
+import re
+import atexit
 import base64
-from typing import List, Dict, Any, Optional
+import hashlib
+import http.cookiejar
+import queue
+import pickle
+import sqlite3
+import threading
+import time
+from io import BytesIO
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from typing import List, Dict, Any, Iterator, Optional
 
 import streamlit as st
 import pandas as pd
 import requests
+import httpx
 import googlemaps
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import lxml.etree
+import lxml.html
 from urllib.parse import urlparse
 
 from openai import OpenAI
 
-# 尝试可选导入 headless 浏览器支持
+# 尝试可选导入 headless 浏览器支持（优先 Playwright，没有再用 requests_html）
+try:
+    from playwright.sync_api import sync_playwright  # 需另外执行 playwright install chromium
+    HAS_PLAYWRIGHT = True
+except Exception:
+    sync_playwright = None
+    HAS_PLAYWRIGHT = False
+
 try:
     from requests_html import HTMLSession  # 可能在某些环境缺依赖
     HAS_REQUESTS_HTML = True
@@ -20,6 +43,38 @@ except Exception:
     HTMLSession = None
     HAS_REQUESTS_HTML = False
 
+# 可选的图片处理库（发给视觉模型前压缩图片）
+try:
+    from PIL import Image
+    HAS_PIL = True
+except Exception:
+    Image = None
+    HAS_PIL = False
+
+# 可选的感知哈希库（依赖 Pillow），用于去掉几乎一样的菜单照片；没有时只去掉完全相同的图片
+try:
+    import imagehash
+    HAS_IMAGEHASH = HAS_PIL
+except Exception:
+    imagehash = None
+    HAS_IMAGEHASH = False
+
+# 可选的快速 JSON 库，不可用时退回标准库 json
+try:
+    import orjson
+    HAS_ORJSON = True
+except Exception:
+    orjson = None
+    HAS_ORJSON = False
+
+# 可选的 tokenizer，用于按 token 数截断发给 LLM 的菜单文本；没有时按字符数粗略估算
+try:
+    import tiktoken
+    HAS_TIKTOKEN = True
+except Exception:
+    tiktoken = None
+    HAS_TIKTOKEN = False
+
 # =========================
 # 基本配置 & Secrets
 # =========================
@@ -49,9 +104,58 @@ if not GOOGLE_API_KEY:
     st.error("缺少 GOOGLE_API_KEY，请先在 Streamlit Secrets 中配置后再刷新。")
     st.stop()
 
+# 全局共享的 HTTP 连接池：同一域名（ScraperAPI / SerpAPI / 餐厅官网）复用 TCP+TLS 连接。
+# 脚本每次 rerun 都会重新执行模块代码，放进 cache_resource 才能跨 rerun / 会话真正复用。
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=50,
+        # 只重试连接失败和网关类状态码；读超时不重试，否则一个卡住的请求会被成倍拉长
+        max_retries=Retry(
+            connect=2,
+            read=0,
+            status=2,
+            backoff_factor=0.3,
+            status_forcelist=(429, 502, 503, 504),
+            # 429 的 Retry-After 可能很长且没有上限，只按自己的退避重试，避免线程被挂起
+            respect_retry_after_header=False,
+        ),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # 会话被所有用户 / 线程共享：只共享连接池，不保存任何 cookie，避免一个用户的站点 cookie 带到别人的请求里
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+HTTP_SESSION = get_http_session()
+
+# (连接超时, 读取超时)：握手卡住时尽快失败，慢渲染的页面仍有足够读取时间
+CONNECT_TIMEOUT_S = 5
+
+# 主模型失败时依次尝试的备用模型
+LLM_MODEL_CHAIN = ["gpt-4.1-mini", "gpt-4o-mini"]
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key: str) -> OpenAI:
+    """
+    OpenAI 客户端单例：跨 rerun 复用同一个 httpx 连接池（有 h2 时启用 HTTP/2），
+    避免每次调用都重新握手 TLS。
+    """
+    limits = httpx.Limits(max_connections=10, max_keepalive_connections=10)
+    try:
+        http_client = httpx.Client(http2=True, limits=limits, timeout=60.0)
+    except ImportError:  # 未安装 h2
+        http_client = httpx.Client(limits=limits, timeout=60.0)
+    return OpenAI(api_key=api_key, http_client=http_client)
+
+
 client: Optional[OpenAI] = None
 if OPENAI_API_KEY:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    client = get_openai_client(OPENAI_API_KEY)
 
 # =========================
 # Session State 初始化
@@ -64,45 +168,233 @@ if "analysis_ready" not in st.session_state:
     st.session_state["analysis_ready"] = False
 if "ocr_menu_texts" not in st.session_state:
     st.session_state["ocr_menu_texts"] = []
+if "nearby_cache" not in st.session_state:
+    st.session_state["nearby_cache"] = None
+if "analysis_memo" not in st.session_state:
+    st.session_state["analysis_memo"] = {}
+
+
+# 跨会话 / 进程重启仍然有效的结果缓存（SQLite 单文件），条目默认 24 小时后过期。
+# 值用 pickle 存取，文件必须放在只有当前用户可读写的私有目录里（0700），
+# 不能放在共享的临时目录，否则别的本地用户可以塞入恶意 pickle。
+DISK_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "delivery_growth",
+)
+DISK_CACHE_PATH = os.path.join(DISK_CACHE_DIR, "cache.sqlite3")
+DISK_CACHE_TTL_S = 24 * 3600
+
+
+@st.cache_resource(show_spinner=False)
+def init_disk_cache(path: str) -> str:
+    """建私有目录和表（每个进程只做一次），返回数据库路径；目录不属于当前用户时报错。"""
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    os.chmod(cache_dir, 0o700)
+    if hasattr(os, "getuid") and os.stat(cache_dir).st_uid != os.getuid():
+        raise PermissionError(f"缓存目录不属于当前用户：{cache_dir}")
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, ts REAL, expires REAL, value BLOB)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+    os.chmod(path, 0o600)
+    return path
+
+
+def disk_cache_get(key: str, ttl_s: float = DISK_CACHE_TTL_S) -> Any:
+    """读取未过期（写入不超过 ttl_s 秒）的缓存值，没有、过期或读取出错都返回 None。"""
+    try:
+        with sqlite3.connect(init_disk_cache(DISK_CACHE_PATH)) as conn:
+            row = conn.execute("SELECT ts, value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[0] > ttl_s:
+            return None
+        return pickle.loads(row[1])
+    except Exception:
+        return None
+
+
+def disk_cache_set(key: str, value: Any, ttl_s: float = DISK_CACHE_TTL_S) -> None:
+    """写入缓存并顺手删掉已过期的条目（菜单照片等值很大，不清理文件会一直涨）；出错直接忽略。"""
+    try:
+        now = time.time()
+        with sqlite3.connect(init_disk_cache(DISK_CACHE_PATH)) as conn:
+            conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, ts, expires, value) VALUES (?, ?, ?, ?)",
+                (key, now, now + ttl_s, pickle.dumps(value)),
+            )
+    except Exception:
+        pass
+
+
+# 同样的 LLM 请求（模型 + 消息完全一致）7 天内直接复用结果，不重复计费
+LLM_CACHE_TTL_S = 7 * 24 * 3600
+
+
+def llm_cache_key(*parts: Any) -> str:
+    """按 LLM 请求内容（模型、消息、参数等）生成磁盘缓存 key。"""
+    raw = None
+    if HAS_ORJSON:
+        # orjson 直接产出 bytes，省掉 str → bytes 的来回编码；按 key 排序保证同内容同 key
+        try:
+            raw = orjson.dumps(
+                parts,
+                option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+            )
+        except TypeError:
+            pass
+    if raw is None:
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return "llm:" + hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def session_memo(key: Any, compute, spinner: Optional[str] = None, persist: Any = False) -> Any:
+    """
+    在 session_state 中按 key（含餐厅 place_id 及相关输入）记住一步分析的结果，
+    重跑脚本时直接取回，不再走网络；只有未命中时才计算并显示 spinner。
+    点击“运行分析”会清空，强制重新计算。
+    persist=True 时再落一份到磁盘缓存，用户隔天重新打开同一家店也不用重新请求；
+    也可以传入 persist(value) -> bool，按结果决定是否落盘（比如有超时的结果不落盘）。
+    """
+    memo = st.session_state["analysis_memo"]
+    pending = memo.get(key)
+    if key in memo and not isinstance(pending, Future):
+        return pending
+
+    disk_key = repr(key)
+    value = disk_cache_get(disk_key) if persist and pending is None else None
+    if value is None:
+        # 已经用 session_prefetch 在后台开始计算的，直接等它的结果
+        run = pending.result if pending is not None else compute
+        try:
+            if spinner:
+                with st.spinner(spinner):
+                    value = run()
+            else:
+                value = run()
+        except Exception:
+            memo.pop(key, None)
+            raise
+        if persist is True or (callable(persist) and persist(value)):
+            disk_cache_set(disk_key, value)
+    memo[key] = value
+    return value
+
+
+def session_prefetch(executor: ThreadPoolExecutor, key: Any, compute, persist: Any = False) -> None:
+    """
+    session_memo 的预取版本：未命中时把 compute 提交到后台线程先跑起来，
+    之后用同一个 key 调 session_memo 时再等结果，互不依赖的网络步骤就能同时进行。
+    compute 在线程里执行，不能调用 st.* 界面函数或读写 session_state。
+    """
+    memo = st.session_state["analysis_memo"]
+    if key in memo:
+        return
+    if persist:
+        value = disk_cache_get(repr(key))
+        if value is not None:
+            memo[key] = value
+            return
+    memo[key] = executor.submit(compute)
+
+# 候选餐厅半径 & 竞对扫描半径：只按大半径查一次 Nearby，小半径在本地按距离筛
+CANDIDATE_RADIUS_M = 300
+COMPETITOR_RADIUS_M = 1500
+# Places Nearby 单页最多返回的结果数（按知名度排序），达到上限说明结果被截断
+PLACES_NEARBY_PAGE_SIZE = 20
 
 # =========================
 # 工具函数（带缓存）
 # =========================
 
-@st.cache_data(show_spinner=False)
+def json_loads(data: Any) -> Any:
+    """解析 JSON（bytes 或 str），优先使用 orjson。"""
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any, indent: bool = False) -> str:
+    """序列化为 JSON 字符串（不转义中文），优先使用 orjson，遇到不支持的类型退回标准库。"""
+    if HAS_ORJSON:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, option=option).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+
+
+# 客户端内部持有 requests.Session：用 cache_resource 全局共享同一个实例，
+# 所有 Google 调用（包括竞对详情并发请求）复用 TLS 长连接；
+# cache_data 每次命中都会反序列化出一个新客户端，连接池形同虚设。
+@st.cache_resource(show_spinner=False)
 def gm_client(key: str):
     return googlemaps.Client(key=key)
 
 
-@st.cache_data(show_spinner=False)
+_ADDRESS_PUNCT_RE = re.compile(r"[.,;]+")
+
+
+def normalize_address(address: str) -> str:
+    """地址规范化（小写、去掉 . , ;、合并空白），写法略有不同的同一地址共用一条缓存。"""
+    return " ".join(_ADDRESS_PUNCT_RE.sub(" ", address.casefold()).split())
+
+
 def google_geocode(api_key: str, address: str) -> List[Dict[str, Any]]:
+    return _google_geocode_cached(api_key, normalize_address(address), address.strip())
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def _google_geocode_cached(
+    api_key: str, normalized_address: str, _address: str
+) -> List[Dict[str, Any]]:
+    """缓存只按规范化后的地址命中；实际请求仍发送用户输入的原始写法（保留逗号有助于解析）。"""
     gmaps = gm_client(api_key)
-    return gmaps.geocode(address)
+    return gmaps.geocode(_address)
+
+
+# Place Details 按请求的字段计费、返回体积也随之变化：只要用得到的字段
+PLACE_DETAIL_FIELDS = (
+    "name",
+    "formatted_address",
+    "formatted_phone_number",
+    "geometry",
+    "rating",
+    "user_ratings_total",
+    "types",
+    "opening_hours",
+    "website",
+    "price_level",
+    "photos",
+    "url",
+)
+# 竞对画像只用到这几项
+COMPETITOR_DETAIL_FIELDS = (
+    "name",
+    "formatted_address",
+    "rating",
+    "user_ratings_total",
+    "price_level",
+    "types",
+)
 
 
-@st.cache_data(show_spinner=False)
-def google_place_details(api_key: str, place_id: str) -> Dict[str, Any]:
+@st.cache_data(show_spinner=False, ttl=3600)
+def google_place_details(
+    api_key: str, place_id: str, fields: tuple = PLACE_DETAIL_FIELDS
+) -> Dict[str, Any]:
     """
     Google Place Details：
     先尝试带 fields，如果 SDK/版本不支持就 fallback 到不带 fields 的调用。
     """
     gmaps = gm_client(api_key)
-    fields = [
-        "name",
-        "formatted_address",
-        "formatted_phone_number",
-        "geometry",
-        "rating",
-        "user_ratings_total",
-        "types",
-        "opening_hours",
-        "website",
-        "price_level",
-        "photos",
-        "url",
-    ]
     try:
-        result = gmaps.place(place_id=place_id, fields=fields)
+        result = gmaps.place(place_id=place_id, fields=list(fields))
         data = result.get("result", result)
     except Exception:
         result = gmaps.place(place_id=place_id)
@@ -110,7 +402,7 @@ def google_place_details(api_key: str, place_id: str) -> Dict[str, Any]:
     return data
 
 
-@st.cache_data(show_spinner=False)
+@st.cache_data(show_spinner=False, ttl=3600)
 def google_places_nearby(
     api_key: str, lat: float, lng: float, radius_m: int, type_: str = "restaurant"
 ) -> List[Dict[str, Any]]:
@@ -119,7 +411,31 @@ def google_places_nearby(
     return result.get("results", [])
 
 
-@st.cache_data(show_spinner=False)
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """两点间球面距离（米）。"""
+    r = 6371000.0
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * r * math.asin(math.sqrt(a))
+
+
+def filter_places_within(
+    places: List[Dict[str, Any]], lat: float, lng: float, radius_m: float
+) -> List[Dict[str, Any]]:
+    """从一次大半径 Nearby 结果里按距离筛出小半径内的餐厅。"""
+    within = []
+    for p in places:
+        loc = (p.get("geometry") or {}).get("location") or {}
+        if "lat" not in loc or "lng" not in loc:
+            continue
+        if haversine_m(lat, lng, loc["lat"], loc["lng"]) <= radius_m:
+            within.append(p)
+    return within
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
 def serpapi_google_maps_search(
     serpapi_key: str, query: str, lat: float, lng: float, zoom: float = 13.0
 ) -> Dict[str, Any]:
@@ -132,16 +448,22 @@ def serpapi_google_maps_search(
         "ll": ll_param,
         "api_key": serpapi_key,
     }
-    resp = requests.get(url, params=params, timeout=30)
+    resp = HTTP_SESSION.get(url, params=params, timeout=(CONNECT_TIMEOUT_S, 30))
     resp.raise_for_status()
-    return resp.json()
+    return json_loads(resp.content)
 
 
 # =========================
 # ScraperAPI 集成
 # =========================
 
-@st.cache_data(show_spinner=False)
+# 页面 HTML / 图片二进制体积大且只读，用 cache_resource 直接返回同一对象，
+# 省掉 cache_data 每次命中时的序列化 + 拷贝；菜单和官网一小时内基本不变，
+# 条目数设上限防止长时间运行后内存无限增长。
+FETCH_CACHE_TTL_S = 3600
+FETCH_CACHE_MAX_ENTRIES = 128
+
+@st.cache_resource(show_spinner=False, ttl=FETCH_CACHE_TTL_S, max_entries=FETCH_CACHE_MAX_ENTRIES)
 def fetch_html_via_scraperapi(url: str, render: bool = True) -> Optional[str]:
     """
     通过 ScraperAPI 抓取页面，自动绕过大部分反爬 & Cloudflare。
@@ -159,7 +481,7 @@ def fetch_html_via_scraperapi(url: str, render: bool = True) -> Optional[str]:
         params["render"] = "true"
 
     try:
-        resp = requests.get(api_endpoint, params=params, timeout=40)
+        resp = HTTP_SESSION.get(api_endpoint, params=params, timeout=(CONNECT_TIMEOUT_S, 40))
         resp.raise_for_status()
         ctype = resp.headers.get("Content-Type", "")
         if "text/html" in ctype or "application/json" in ctype:
@@ -169,14 +491,191 @@ def fetch_html_via_scraperapi(url: str, render: bool = True) -> Optional[str]:
         return None
 
 
-@st.cache_data(show_spinner=False)
+# 常见第三方外卖 / 点餐平台（强 JS、反爬）
+_HARD_DOMAINS = frozenset({
+    "doordash.com",
+    "ubereats.com",
+    "grubhub.com",
+    "order.online",
+    "hungrypanda.co",
+    "fantuan.ca",
+    "chownow.com",
+})
+_DELIVERY_DOMAIN_RE = re.compile(
+    r"doordash\.com|ubereats\.com|grubhub\.com|hungrypanda\.co|fantuan\.ca|order\.online|chownow\.com",
+    re.IGNORECASE,
+)
+
+# 反爬拦截页的典型字样
+_BLOCKED_PAGE_RE = re.compile(r"captcha|access denied|temporarily blocked", re.IGNORECASE)
+
+# Playwright 同步 API 只能在启动它的线程里使用，而 fetch_html 会在多个线程里被调用，
+# 所以由一个常驻线程持有浏览器，渲染任务通过队列投递过去；浏览器只启动一次，
+# 每个 URL 用独立的 context。
+# 所有用户共用这一个渲染线程：队列有上限，排满直接放弃；每次调用（排队 + 渲染）总共
+# 最多等 PLAYWRIGHT_RENDER_TIMEOUT_S 秒，渲染线程按剩余时间给 goto 设超时，
+# 调用方放弃后不会再占着浏览器。
+PLAYWRIGHT_GOTO_TIMEOUT_S = 30
+PLAYWRIGHT_RENDER_TIMEOUT_S = 25
+PLAYWRIGHT_QUEUE_MAX = 4
+
+
+def _playwright_worker(renderer: Dict[str, Any]) -> None:
+    jobs: "queue.Queue" = renderer["jobs"]
+    pw = None
+    browser = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        url, user_agent, fut, deadline = job
+        if not fut.set_running_or_notify_cancel():
+            continue
+        if renderer["unavailable"]:
+            fut.set_exception(RuntimeError("Playwright 浏览器不可用"))
+            continue
+        try:
+            if browser is None:
+                pw = sync_playwright().start()
+                try:
+                    browser = pw.chromium.launch()
+                except Exception:
+                    # 多半是没执行 playwright install chromium：停掉 pw，之后不再重复启动
+                    pw.stop()
+                    pw = None
+                    renderer["unavailable"] = True
+                    raise
+            remaining = min(deadline - time.monotonic(), PLAYWRIGHT_GOTO_TIMEOUT_S)
+            if remaining <= 1:
+                # 调用方已经等不到结果了，不再占用浏览器
+                fut.set_exception(TimeoutError("渲染任务排队超时"))
+                continue
+            ctx = browser.new_context(user_agent=user_agent)
+            try:
+                page = ctx.new_page()
+                page.goto(url, timeout=remaining * 1000, wait_until="networkidle")
+                fut.set_result(page.content())
+            finally:
+                ctx.close()
+        except Exception as e:
+            fut.set_exception(e)
+
+    if browser is not None:
+        browser.close()
+    if pw is not None:
+        pw.stop()
+
+
+def _stop_playwright_worker(jobs: "queue.Queue", thread: threading.Thread) -> None:
+    try:
+        jobs.put(None, timeout=1)
+    except queue.Full:
+        return
+    thread.join(timeout=10)
+
+
+@st.cache_resource(show_spinner=False)
+def get_playwright_renderer() -> Dict[str, Any]:
+    """启动（仅一次）持有浏览器的渲染线程，返回 {任务队列, 线程, 浏览器是否不可用}。"""
+    renderer: Dict[str, Any] = {
+        "jobs": queue.Queue(maxsize=PLAYWRIGHT_QUEUE_MAX),
+        "unavailable": False,
+    }
+    thread = threading.Thread(
+        target=_playwright_worker, args=(renderer,), name="playwright", daemon=True
+    )
+    renderer["thread"] = thread
+    thread.start()
+    atexit.register(_stop_playwright_worker, renderer["jobs"], thread)
+    return renderer
+
+
+def render_with_playwright(url: str, user_agent: str) -> Optional[str]:
+    """用共享的 headless Chromium 渲染页面；队列已满、失败或超时（含排队时间）返回 None。"""
+    renderer = get_playwright_renderer()
+    fut: Future = Future()
+    try:
+        renderer["jobs"].put_nowait(
+            (url, user_agent, fut, time.monotonic() + PLAYWRIGHT_RENDER_TIMEOUT_S)
+        )
+    except queue.Full:
+        return None
+    try:
+        return fut.result(timeout=PLAYWRIGHT_RENDER_TIMEOUT_S)
+    except Exception:
+        fut.cancel()
+        return None
+
+
+# 各域名的渲染策略：
+# - "skip_headless"：本地 headless 也绕不过（需要登录 cookie / JS challenge），失败就直接放弃
+# - "render_only"：纯 JS SPA，普通请求拿不到内容，直接走渲染
+_RENDER_POLICY: Dict[str, str] = {
+    "doordash.com": "skip_headless",
+    "ubereats.com": "skip_headless",
+    "grubhub.com": "skip_headless",
+    "chownow.com": "render_only",
+    "order.online": "render_only",
+}
+
+
+def match_domain(host: str, domains: Any) -> Optional[str]:
+    """
+    判断 host 是否属于 domains 中某个域名（含子域名），返回命中的域名。
+    逐级取 host 的后缀做集合查找，不受 URL 路径 / 参数里出现域名字样的干扰。
+    """
+    parts = host.lower().split(".")
+    for i in range(len(parts) - 1):
+        suffix = ".".join(parts[i:])
+        if suffix in domains:
+            return suffix
+    return None
+
+
+def get_render_policy(host: str) -> Optional[str]:
+    """按域名（含子域名）查找渲染策略，没有匹配返回 None。"""
+    domain = match_domain(host, _RENDER_POLICY)
+    return _RENDER_POLICY[domain] if domain else None
+
+
+# 普通请求最多读取的正文字节数：首页 / 菜单内容都在前面，超大的 SPA 页面不再整页下载
+MAX_HTML_BYTES = 2 * 1024 * 1024
+
+
+def _read_capped_text(resp: requests.Response, max_bytes: int) -> str:
+    """流式读取响应正文，读满 max_bytes 即停止，按响应声明的编码解码。"""
+    buf = bytearray()
+    for chunk in resp.iter_content(chunk_size=64 * 1024):
+        buf += chunk
+        if len(buf) >= max_bytes:
+            break
+    data = bytes(buf[:max_bytes])
+    try:
+        return data.decode(resp.encoding or "utf-8", errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
+
+
+# 不渲染抓到的页面至少要这么大，且出现价格符号 / 菜品词，才认为已经有菜单内容
+MIN_STATIC_MENU_HTML_LEN = 5000
+
+
+def looks_like_menu_html(html: str) -> bool:
+    # 关键词只在可见文本里找：脚本里的 $（jQuery 等）会让未渲染的 SPA 空壳误判为菜单
+    if len(html) <= MIN_STATIC_MENU_HTML_LEN:
+        return False
+    return bool(_MENU_KW_RE.search(extract_menu_text_from_html(html)))
+
+
+@st.cache_resource(show_spinner=False, ttl=FETCH_CACHE_TTL_S, max_entries=FETCH_CACHE_MAX_ENTRIES)
 def fetch_html(url: str) -> Optional[str]:
     """
     统一页面抓取逻辑：
     1）遇到典型强 JS/反爬域名（Doordash/order.online 等）优先走 ScraperAPI；
     2）普通请求试一次；
     3）失败再走 ScraperAPI；
-    4）再失败用本地 headless（requests_html）兜底。
+    4）再失败用本地 headless（Playwright / requests_html）兜底。
+    已知域名按 _RENDER_POLICY 跳过无效步骤，避免白等 40 秒。
     """
     headers = {
         "User-Agent": (
@@ -187,40 +686,33 @@ def fetch_html(url: str) -> Optional[str]:
         "Accept-Language": "en-US,en;q=0.9,zh-CN;q=0.8",
     }
 
-    hard_domains = [
-        "doordash.com",
-        "ubereats.com",
-        "grubhub.com",
-        "order.online",
-        "hungrypanda.co",
-        "fantuan.ca",
-        "chownow.com",
-    ]
-    lower_url = url.lower()
+    host = urlparse(url).hostname or ""
+    policy = get_render_policy(host)
 
-    # 0️⃣ 某些第三方点餐网站直接走 ScraperAPI + JS 渲染
-    if any(d in lower_url for d in hard_domains):
+    # 0️⃣ 某些第三方点餐网站直接走 ScraperAPI：先试不渲染（便宜、快，部分店铺页是服务端渲染），
+    #    内容不像菜单再开 JS 渲染
+    if match_domain(host, _HARD_DOMAINS):
+        html = fetch_html_via_scraperapi(url, render=False)
+        if html and looks_like_menu_html(html):
+            return html
         html = fetch_html_via_scraperapi(url, render=True)
         if html:
             return html
 
-    # 1️⃣ 普通请求（适合自家官网、简单点餐站）
-    try:
-        resp = requests.get(url, headers=headers, timeout=15)
-        ctype = resp.headers.get("Content-Type", "")
-        body = resp.text
-
-        blocked = (
-            resp.status_code >= 400
-            or "captcha" in body.lower()
-            or "access denied" in body.lower()
-            or "temporarily blocked" in body.lower()
-        )
-
-        if resp.status_code < 400 and "text/html" in ctype and not blocked:
-            return body
-    except Exception:
-        pass
+    # 1️⃣ 普通请求（适合自家官网、简单点餐站）；纯 JS 站点跳过
+    if policy != "render_only":
+        try:
+            with HTTP_SESSION.get(
+                url, headers=headers, timeout=(CONNECT_TIMEOUT_S, 15), stream=True
+            ) as resp:
+                ctype = resp.headers.get("Content-Type", "")
+                # 出错或不是 HTML（PDF 菜单、图片等）就不下载正文
+                if resp.status_code < 400 and "text/html" in ctype:
+                    body = _read_capped_text(resp, MAX_HTML_BYTES)
+                    if not _BLOCKED_PAGE_RE.search(body):
+                        return body
+        except Exception:
+            pass
 
     # 2️⃣ 普通请求失败 → ScraperAPI（渲染打开）
     if SCRAPERAPI_KEY:
@@ -228,7 +720,16 @@ def fetch_html(url: str) -> Optional[str]:
         if html:
             return html
 
-    # 3️⃣ 再失败 → requests_html headless 渲染（如果可用）
+    # 3️⃣ 再失败 → 本地 headless 渲染（Playwright 共享浏览器 / requests_html）
+    if policy == "skip_headless":
+        return None
+
+    # 浏览器启动失败（例如没装 Chromium）时才退回 requests_html，正常渲染失败直接放弃
+    if HAS_PLAYWRIGHT and not get_playwright_renderer()["unavailable"]:
+        html = render_with_playwright(url, headers["User-Agent"])
+        if html or not get_playwright_renderer()["unavailable"]:
+            return html
+
     if not HAS_REQUESTS_HTML:
         return None
 
@@ -244,7 +745,7 @@ def fetch_html(url: str) -> Optional[str]:
 # Google 菜单照片 & OCR
 # =========================
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False, ttl=FETCH_CACHE_TTL_S, max_entries=FETCH_CACHE_MAX_ENTRIES)
 def fetch_place_photo(api_key: str, photo_reference: str, maxwidth: int = 1200) -> bytes:
     """
     调用 Google Place Photos API，返回图片二进制。
@@ -255,99 +756,289 @@ def fetch_place_photo(api_key: str, photo_reference: str, maxwidth: int = 1200)
         "photoreference": photo_reference,
         "maxwidth": maxwidth,
     }
-    resp = requests.get(url, params=params, timeout=30)
+    resp = HTTP_SESSION.get(url, params=params, timeout=(CONNECT_TIMEOUT_S, 30))
     resp.raise_for_status()
     return resp.content
 
 
-def classify_menu_image(img_bytes: bytes) -> str:
+@st.cache_data(show_spinner=False, ttl=FETCH_CACHE_TTL_S)
+def fetch_place_photo_url(api_key: str, photo_reference: str, maxwidth: int = 1000) -> Optional[str]:
     """
-    使用 GPT 多模态判断图片类型：
-    返回：
-      - "menu_page"           明显是菜牌/菜单页面
-      - "food_dish"           单道菜/几道菜的摆盘照片
-      - "storefront_or_other" 店招、Logo、环境、人像等
+    Place Photos 接口会 302 跳转到不带 API key 的 googleusercontent 图片地址。
+    把这个地址直接交给视觉模型，模型自己去拉图，省掉下载 + base64 上传。
+    拿不到（或跳转地址里带 key）时返回 None，调用方退回 base64。
     """
-    if client is None:
-        return "storefront_or_other"
+    url = "https://maps.googleapis.com/maps/api/place/photo"
+    params = {
+        "key": api_key,
+        "photoreference": photo_reference,
+        "maxwidth": maxwidth,
+    }
+    try:
+        resp = HTTP_SESSION.get(
+            url, params=params, timeout=(CONNECT_TIMEOUT_S, 15), allow_redirects=False
+        )
+    except Exception:
+        return None
+    location = resp.headers.get("Location", "")
+    if resp.is_redirect and location.startswith("https://") and api_key not in location:
+        return location
+    return None
+
+
+# 发给视觉模型前的图片长边上限：分类只需要缩略图，OCR 需要看清小字
+CLASSIFY_IMAGE_MAX_SIDE = 512
+OCR_IMAGE_MAX_SIDE = 1024
+# 页面上菜单图预览的缩略图尺寸
+PREVIEW_IMAGE_MAX_SIDE = 256
+
+
+def _prepare_image(img_bytes: bytes, max_side: int = 512, quality: int = 80) -> bytes:
+    """
+    缩放到长边不超过 max_side 并重新压缩为 JPEG，减少上传字节和视觉 token。
+    没有 Pillow 或图片无法解析时原样返回。
+    """
+    if not HAS_PIL:
+        return img_bytes
+    try:
+        img = Image.open(BytesIO(img_bytes))
+        img.thumbnail((max_side, max_side))
+        buf = BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=quality, optimize=True)
+        return buf.getvalue()
+    except Exception:
+        return img_bytes
 
-    b64 = base64.b64encode(img_bytes).decode("utf-8")
-    data_url = f"data:image/jpeg;base64,{b64}"
 
-    prompt = """
-你是一名餐饮图片识别助手，请只根据图片内容判断图片类型，不要做其他事情。
+def _to_data_url(img_bytes: bytes, max_side: int, quality: int) -> str:
+    """压缩并编码为 data URL（拿不到公开图片地址时的兜底）。"""
+    small = _prepare_image(img_bytes, max_side, quality)
+    return "data:image/jpeg;base64," + base64.b64encode(small).decode("ascii")
 
-请从下面三种类型中选一个，并只输出对应的英文代码（不要加解释）：
 
-1. 如果图片主要内容是「菜单/菜牌页面」，特征包括：
-   - 有成列的菜品名称、描述和价格
-   - 看起来像打印出来的 menu / laminated menu / 手写菜单板
-   - 可能是一页或多页菜单的照片
-   请输出：menu_page
+# 图片类型判定规则（单张 / 批量分类共用），压缩成要点以减少每次请求的 prompt token
+_IMAGE_TYPE_RULES = """
+- menu_page：菜单/菜牌页面（成列的菜名、描述、价格；打印菜单、过塑菜单、手写菜单板）
+- food_dish：一盘或几盘菜、饮品的实拍，没有成列的菜单条目和价格
+- storefront_or_other：店招、门面、Logo、环境、人像、街景等
+"""
 
-2. 如果图片主要内容是「一盘或几盘菜、饮品」，特征包括：
-   - 看得到实际食物/饮料摆盘
-   - 没有成列的菜单条目和价格
-   请输出：food_dish
+_CLASSIFY_PROMPT = f"""
+你是餐饮图片识别助手，只根据图片内容判断类型，从以下三种中选一个：
+{_IMAGE_TYPE_RULES}
+只输出一个英文代码，不要任何说明。
+"""
 
-3. 如果图片主要内容是「店招、门面、Logo、环境、人像、街景等」，而不是菜单或菜品特写，
-   请输出：storefront_or_other
+# {n} 为本次请求的图片张数
+_CLASSIFY_BATCH_PROMPT = f"""
+你是餐饮图片识别助手，下面依次给出 {{n}} 张图片（图片 1 到图片 {{n}}），
+对每张图片只根据内容从以下三种中选一个：
+{_IMAGE_TYPE_RULES}
+按图片顺序输出 {{n}} 行，每行只写一个英文代码，不要编号，不要任何说明。
+"""
 
-重要规则：
-- 只输出以上三种之一的英文代码，不要输出任何说明文字。
+_OCR_PROMPT = """
+判断图片是否为有用的菜单相关图片，并按规则输出：
+1. 有菜单文字（菜名/描述/价格/菜单排版）：只提取菜名和价格，每行一个菜，
+   格式：菜名原文 - 英文名(没有就留空) - 价格；多种规格可拆成多行。
+2. 没有文字，但能看清一盘菜或一杯饮品：猜 1-3 个候选，每行一个，
+   格式：猜测菜名(中文) - English name - unknown
+3. 只是店招、Logo、人像、街景、室内环境，看不清菜品：返回空字符串。
+只输出菜单条目文本，不要标题、说明或前后缀。
 """
 
+_VALID_IMAGE_LABELS = frozenset({"menu_page", "food_dish", "storefront_or_other"})
+_IMAGE_LABEL_RE = re.compile(r"menu_page|food_dish|storefront_or_other")
+
+# 单次请求最多带几张图片做分类
+CLASSIFY_BATCH_SIZE = 10
+
+
+def classify_menu_image(img_bytes: Optional[bytes] = None, image_url: Optional[str] = None) -> str:
+    """
+    使用 GPT 多模态判断图片类型：
+    返回：
+      - "menu_page"           明显是菜牌/菜单页面
+      - "food_dish"           单道菜/几道菜的摆盘照片
+      - "storefront_or_other" 店招、Logo、环境、人像等
+    """
+    if client is None:
+        return "storefront_or_other"
+
+    if image_url is None:
+        image_url = _to_data_url(img_bytes, CLASSIFY_IMAGE_MAX_SIDE, 75)
+
     resp = client.chat.completions.create(
         model="gpt-4.1-mini",
         messages=[
             {
                 "role": "user",
                 "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": data_url}},
+                    {"type": "text", "text": _CLASSIFY_PROMPT},
+                    {"type": "image_url", "image_url": {"url": image_url, "detail": "low"}},
                 ],
             }
         ],
         temperature=0.0,
     )
-    label = (resp.choices[0].message.content or "").strip().lower()
-    if label not in {"menu_page", "food_dish", "storefront_or_other"}:
-        return "storefront_or_other"
-    return label
+    raw = (resp.choices[0].message.content or "").strip()
+    label = raw if raw in _VALID_IMAGE_LABELS else raw.lower()
+    return label if label in _VALID_IMAGE_LABELS else "storefront_or_other"
 
 
-def get_place_photos(place_detail: Dict[str, Any], max_photos: int = 20) -> List[Dict[str, Any]]:
+def classify_menu_images_batch(image_urls: List[str]) -> List[str]:
     """
-    从 Place Details 中获取照片，并自动筛选出“菜单页”优先返回。
+    一次请求对多张图片分类，返回与输入顺序一致的标签列表。
+    image_urls 可以是公开图片地址或 data URL。
+    模型返回的标签数量对不上时，退回逐张调用 classify_menu_image。
     """
-    photos = place_detail.get("photos", []) or []
-    results: List[Dict[str, Any]] = []
-    if not photos:
-        return results
+    if not image_urls:
+        return []
+    if client is None:
+        return ["storefront_or_other"] * len(image_urls)
+    if len(image_urls) == 1:
+        return [classify_menu_image(image_url=image_urls[0])]
 
-    for p in photos[:max_photos]:
-        ref = p.get("photo_reference")
-        if not ref:
-            continue
+    n = len(image_urls)
+    prompt = _CLASSIFY_BATCH_PROMPT.format(n=n)
+    content: List[Dict[str, Any]] = [{"type": "text", "text": prompt}]
+    for i, image_url in enumerate(image_urls, start=1):
+        content.append({"type": "text", "text": f"图片 {i}："})
+        content.append({"type": "image_url", "image_url": {"url": image_url, "detail": "low"}})
+
+    try:
+        resp = client.chat.completions.create(
+            model="gpt-4.1-mini",
+            messages=[{"role": "user", "content": content}],
+            temperature=0.0,
+        )
+        labels = _IMAGE_LABEL_RE.findall((resp.choices[0].message.content or "").lower())
+    except Exception:
+        labels = []
+
+    if len(labels) != n:
+        return [classify_menu_image(image_url=image_url) for image_url in image_urls]
+    return labels
+
+
+def _fetch_photo_safe(photo_reference: str) -> Optional[bytes]:
+    try:
+        return fetch_place_photo(GOOGLE_API_KEY, photo_reference, maxwidth=1000)
+    except Exception:
+        return None
+
+
+def _download_photo_safe(photo_reference: str, image_url: Optional[str]) -> Optional[bytes]:
+    """
+    优先从跳转后的 googleusercontent 地址下载（不计费），
+    没有地址或下载失败才走计费的 Place Photos 接口。
+    """
+    if image_url:
         try:
-            img_bytes = fetch_place_photo(GOOGLE_API_KEY, ref, maxwidth=1000)
+            resp = HTTP_SESSION.get(image_url, timeout=(CONNECT_TIMEOUT_S, 30))
+            resp.raise_for_status()
+            return resp.content
         except Exception:
+            pass
+    return _fetch_photo_safe(photo_reference)
+
+
+def _classify_image_url(photo_reference: str, image_url: Optional[str]) -> Optional[str]:
+    """分类用的图片地址：有公开地址直接用（detail=low 由模型自行缩小），否则下载转 data URL。"""
+    if image_url:
+        return image_url
+    img_bytes = _fetch_photo_safe(photo_reference)
+    return _to_data_url(img_bytes, CLASSIFY_IMAGE_MAX_SIDE, 75) if img_bytes else None
+
+
+# 感知哈希汉明距离不超过该值的两张图视为同一页菜单
+PHOTO_DUP_MAX_DISTANCE = 4
+
+
+def dedupe_menu_photos(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    去掉重复的菜单照片（同一页菜单常被不同用户上传多次），保留先出现的那张，
+    省掉重复的 OCR 调用。有 imagehash 时按感知哈希判断近似重复，否则只按字节完全相同判断。
+    """
+    unique: List[Dict[str, Any]] = []
+    seen_bytes = set()
+    hashes = []
+    for item in items:
+        img_bytes = item["image_bytes"]
+        if img_bytes in seen_bytes:
             continue
+        seen_bytes.add(img_bytes)
+        if HAS_IMAGEHASH:
+            try:
+                h = imagehash.phash(Image.open(BytesIO(img_bytes)))
+            except Exception:
+                h = None
+            if h is not None:
+                if any(h - prev <= PHOTO_DUP_MAX_DISTANCE for prev in hashes):
+                    continue
+                hashes.append(h)
+        unique.append(item)
+    return unique
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def get_place_photos(place_detail: Dict[str, Any], max_photos: int = 20) -> List[Dict[str, Any]]:
+    """
+    从 Place Details 中获取照片，并自动筛选出“菜单页”优先返回。
+    分类直接把图片地址交给模型（按 CLASSIFY_BATCH_SIZE 张一批合并请求），
+    只有判定为菜单页的照片才从公开地址下载原图用于展示，结果保持原照片顺序并去掉重复页。
+    每个结果带 image_url（OCR 分辨率的图片地址，可能为 None）。
+    """
+    photos = place_detail.get("photos", []) or []
+    refs = [p.get("photo_reference") for p in photos[:max_photos]]
+    refs = [r for r in refs if r]
+    if not refs:
+        return []
 
-        label = classify_menu_image(img_bytes)
-        if label == "menu_page":
-            results.append(
-                {
-                    "photo_reference": ref,
-                    "image_bytes": img_bytes,
-                    "label": label,
-                }
+    with ThreadPoolExecutor(max_workers=min(8, len(refs))) as ex:
+        # Place Photos 每次请求（包括只拿跳转地址）都计费：每张照片只按 OCR 分辨率解析一次跳转，
+        # 分类、下载预览图、OCR 都复用这个地址
+        photo_urls = list(
+            ex.map(
+                lambda r: fetch_place_photo_url(GOOGLE_API_KEY, r, maxwidth=OCR_IMAGE_MAX_SIDE),
+                refs,
             )
+        )
+        sources = [
+            (ref, photo_url, classify_url)
+            for ref, photo_url, classify_url in zip(
+                refs, photo_urls, ex.map(_classify_image_url, refs, photo_urls)
+            )
+            if classify_url
+        ]
+        batches = [
+            [classify_url for _, _, classify_url in sources[i:i + CLASSIFY_BATCH_SIZE]]
+            for i in range(0, len(sources), CLASSIFY_BATCH_SIZE)
+        ]
+        labels = [label for batch in ex.map(classify_menu_images_batch, batches) for label in batch]
 
-    return results
+        menu_sources = [
+            (ref, photo_url)
+            for (ref, photo_url, _), label in zip(sources, labels)
+            if label == "menu_page"
+        ]
+        menu_bytes = list(ex.map(lambda m: _download_photo_safe(*m), menu_sources))
+
+    return dedupe_menu_photos(
+        [
+            {
+                "photo_reference": ref,
+                "image_bytes": img_bytes,
+                "image_url": photo_url,
+                "label": "menu_page",
+            }
+            for (ref, photo_url), img_bytes in zip(menu_sources, menu_bytes)
+            if img_bytes
+        ]
+    )
 
 
-def ocr_menu_from_image_bytes(img_bytes: bytes) -> str:
+def ocr_menu_from_image_bytes(img_bytes: bytes, image_url: Optional[str] = None) -> str:
     """
     使用 OpenAI 多模态从图片中提取菜单信息：
     - 如果有菜单文字：输出菜名 + 价格
@@ -357,35 +1048,8 @@ def ocr_menu_from_image_bytes(img_bytes: bytes) -> str:
     if client is None:
         return ""
 
-    b64 = base64.b64encode(img_bytes).decode("utf-8")
-    data_url = f"data:image/jpeg;base64,{b64}"
-
-    prompt = """
-你现在要判断这张图片是不是“有用的菜单相关图片”。
-
-请按以下逻辑处理：
-
-1. 如果图片上有明显的菜单文字（例如菜名、描述、价格、类似菜单排版）：
-   - 只提取菜品名称和价格。
-   - 每行输出一个菜，格式：
-     菜名原文 - 英文名(如果有就写，没有就留空) - 价格
-   - 如果是多种规格，可以拆成多行。
-   - 不要输出任何额外说明。
-
-2. 如果图片上没有明显的文字，但能清楚看到一盘菜或一杯饮料等“单品菜品照片”：
-   - 猜测该菜/饮品最可能的中英文名称。
-   - 每行输出一个候选，格式：
-     猜测菜名(中文，如果你知道) - English name(如果能判断) - unknown
-   - 最多输出 1-3 行。
-   - 不要输出其他解释。
-
-3. 如果图片主要是店招、Logo、人像、街景、室内环境，没有可识别的菜单文字，也看不清具体菜品：
-   - 不要输出任何内容，返回完全空的结果。
-
-总规则：
-- 只输出菜单条目文本，不要加标题、说明、前后缀。
-- 如果最后判断属于第 3 种情况，就返回空字符串。
-"""
+    if image_url is None:
+        image_url = _to_data_url(img_bytes, OCR_IMAGE_MAX_SIDE, 85)
 
     resp = client.chat.completions.create(
         model="gpt-4.1-mini",
@@ -393,8 +1057,8 @@ def ocr_menu_from_image_bytes(img_bytes: bytes) -> str:
             {
                 "role": "user",
                 "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": data_url}},
+                    {"type": "text", "text": _OCR_PROMPT},
+                    {"type": "image_url", "image_url": {"url": image_url, "detail": "high"}},
                 ],
             }
         ],
@@ -403,67 +1067,156 @@ def ocr_menu_from_image_bytes(img_bytes: bytes) -> str:
     text = resp.choices[0].message.content or ""
     return text.strip()
 
+
+# 同时在途的 OCR 请求数，可用环境变量 OCR_CONCURRENCY 调整
+OCR_CONCURRENCY = max(1, int(os.environ.get("OCR_CONCURRENCY") or os.cpu_count() or 4))
+
+
+@st.cache_data(show_spinner=False, persist="disk")
+def ocr_menu_cached(img_hash: str, _img_bytes: bytes, _image_url: Optional[str] = None) -> str:
+    """
+    按图片内容哈希缓存 OCR 结果（落盘，重启后仍有效）：同一家店第二天再打开不再重复付费识别。
+    下划线参数不参与缓存 key，图片字节只在未命中时才用到。
+    """
+    return ocr_menu_from_image_bytes(_img_bytes, image_url=_image_url)
+
+
+def _ocr_photo_safe(item: Dict[str, Any]) -> str:
+    """对单张菜单页做 OCR，出错返回空字符串，避免一张失败拖垮整批。"""
+    img_bytes = item["image_bytes"]
+    try:
+        return ocr_menu_cached(
+            hashlib.blake2b(img_bytes, digest_size=16).hexdigest(),
+            img_bytes,
+            item.get("image_url"),
+        )
+    except Exception:
+        return ""
+
+
+def ocr_menu_photos(
+    menu_photos: List[Dict[str, Any]],
+    on_progress=None,
+) -> List[str]:
+    """
+    并发对多张菜单页做 OCR，结果按原图片顺序返回（已去掉空结果）。
+    on_progress(done, total) 在主线程里随每张完成回调，用于刷新进度条。
+    """
+    if not menu_photos:
+        return []
+
+    texts = [""] * len(menu_photos)
+    with ThreadPoolExecutor(max_workers=min(OCR_CONCURRENCY, len(menu_photos))) as ex:
+        futures = {ex.submit(_ocr_photo_safe, item): i for i, item in enumerate(menu_photos)}
+        for done, fut in enumerate(as_completed(futures), start=1):
+            texts[futures[fut]] = fut.result()
+            if on_progress is not None:
+                on_progress(done, len(menu_photos))
+    return [t for t in texts if t]
+
 # =========================
 # 评分 & 计算函数
 # =========================
 
+@st.cache_data(show_spinner=False, ttl=3600)
 def score_gbp_profile(place: Dict[str, Any]) -> Dict[str, Any]:
     """简化版 Google 商家资料评分，总分 40 分。"""
-    score = 0
-    checks: Dict[str, Any] = {}
-
-    has_name = bool(place.get("name"))
-    has_address = bool(place.get("formatted_address"))
-    pts = 4 if (has_name and has_address) else 0
-    score += pts
-    checks["名称/地址完整"] = (pts, has_name and has_address)
+    opening_hours = place.get("opening_hours") or {}
+    types_ = place.get("types") or []
+    reviews = place.get("user_ratings_total") or 0
 
+    has_name_address = bool(place.get("name")) and bool(place.get("formatted_address"))
     has_phone = bool(place.get("formatted_phone_number"))
-    pts = 4 if has_phone else 0
-    score += pts
-    checks["电话"] = (pts, has_phone)
-
-    opening_hours = place.get("opening_hours", {})
     has_hours = bool(opening_hours.get("weekday_text")) or opening_hours.get("open_now") is not None
-    pts = 4 if has_hours else 0
-    score += pts
-    checks["营业时间"] = (pts, has_hours)
-
     has_website = bool(place.get("website"))
-    pts = 4 if has_website else 0
-    score += pts
-    checks["网站链接"] = (pts, has_website)
+    has_reviews = place.get("rating") is not None and reviews >= 10
+    has_category = bool(set(types_) - {"point_of_interest"})
+    has_price_level = place.get("price_level") is not None
+    has_photos = bool(place.get("photos"))
+
+    # (检查项, 满分, 是否达标)
+    items = [
+        ("名称/地址完整", 4, has_name_address),
+        ("电话", 4, has_phone),
+        ("营业时间", 4, has_hours),
+        ("网站链接", 4, has_website),
+        ("评分 & ≥10条评论", 6, has_reviews),
+        ("类别设置", 6, has_category),
+        ("价格区间", 4, has_price_level),
+        ("照片/图片", 8, has_photos),
+    ]
+    checks = {name: (pts if ok else 0, ok) for name, pts, ok in items}
+    score = sum(pts for pts, _ in checks.values())
 
-    rating = place.get("rating")
-    reviews = place.get("user_ratings_total", 0)
-    has_reviews = rating is not None and reviews >= 10
-    pts = 6 if has_reviews else 0
-    score += pts
-    checks["评分 & ≥10条评论"] = (pts, has_reviews)
+    return {"score": score, "checks": checks}
 
-    types_ = place.get("types", [])
-    has_category = any(t for t in types_ if t != "point_of_interest")
-    pts = 6 if has_category else 0
-    score += pts
-    checks["类别设置"] = (pts, has_category)
 
-    has_price_level = place.get("price_level") is not None
-    pts = 4 if has_price_level else 0
-    score += pts
-    checks["价格区间"] = (pts, has_price_level)
+def _parse_html_doc(html: str) -> Optional[Any]:
+    """lxml 解析 HTML；带 XML 编码声明的页面需以 bytes 传入，空文档返回 None。"""
+    try:
+        try:
+            return lxml.html.fromstring(html)
+        except ValueError:
+            return lxml.html.fromstring(html.encode("utf-8"))
+    except Exception:
+        return None
 
-    photos = place.get("photos", [])
-    has_photos = len(photos) > 0
-    pts = 8 if has_photos else 0
-    score += pts
-    checks["照片/图片"] = (pts, has_photos)
 
-    return {"score": score, "checks": checks}
+@st.cache_data(show_spinner=False, ttl=3600)
+def parse_site(html: Optional[str]) -> Dict[str, Any]:
+    """
+    官网 HTML 只解析一次，提取网站评分和菜单链接发现都要用到的字段：
+    title / meta description / h1 / 正文文本 / 所有 <a href> 链接及锚文本。
+    """
+    site: Dict[str, Any] = {
+        "ok": False,
+        "title": "",
+        "has_desc": False,
+        "has_h1": False,
+        "text": "",
+        "anchors": [],
+    }
+    doc = _parse_html_doc(html) if html else None
+    if doc is None:
+        return site
+
+    # 链接要在删 noscript 之前收集：不少站点把菜单 / 点单链接放在 <noscript> 里
+    anchors = [
+        (href, el.text_content().strip())
+        for el, attr, href, _pos in doc.iterlinks()
+        if el.tag == "a" and attr == "href"
+    ]
 
+    # 脚本 / 样式 / 注释不算页面文本（与 BeautifulSoup.get_text 一致）
+    for el in doc.xpath(".//script|.//style|.//noscript|.//comment()"):
+        el.drop_tree()
+
+    title_el = doc.find(".//title")
+    h1 = doc.find(".//h1")
+    site.update(
+        {
+            "ok": True,
+            "title": title_el.text_content().strip() if title_el is not None else "",
+            "has_desc": any(c.strip() for c in doc.xpath('//meta[@name="description"]/@content')),
+            "has_h1": bool(h1 is not None and h1.text_content().strip()),
+            "text": " ".join(" ".join(doc.itertext()).split()),
+            "anchors": anchors,
+        }
+    )
+    return site
 
-def score_website_basic(url: str, html: Optional[str]) -> Dict[str, Any]:
-    """简化版网站评分，总分 40 分 + 返回文本摘要。"""
-    if not url or not html:
+
+_PHONE_HINT_RE = re.compile(r"[()\-]|\+1")
+_CUISINE_KW_RE = re.compile(
+    r"chinese|cantonese|szechuan|sichuan|shanghai|dim sum|noodle|rice|dumpling|hot pot|bbq",
+    re.IGNORECASE,
+)
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def score_website_basic(url: str, site: Dict[str, Any]) -> Dict[str, Any]:
+    """简化版网站评分，总分 40 分 + 返回文本摘要。site 为 parse_site 的结果。"""
+    if not url or not site.get("ok"):
         return {
             "score": 0,
             "checks": {"无法访问网站": (0, False)},
@@ -472,28 +1225,25 @@ def score_website_basic(url: str, html: Optional[str]) -> Dict[str, Any]:
             "text_snippet": "",
         }
 
-    soup = BeautifulSoup(html, "lxml")
     score = 0
     checks: Dict[str, Any] = {}
 
-    texts = soup.get_text(separator=" ", strip=True)
+    texts = site["text"]
     word_count = len(texts.split())
     text_snippet = texts[:3000]
 
-    title = soup.title.string.strip() if soup.title and soup.title.string else ""
+    title = site["title"]
     has_title = bool(title)
     pts = 6 if has_title else 0
     score += pts
     checks["有页面标题（title）"] = (pts, has_title)
 
-    desc_tag = soup.find("meta", attrs={"name": "description"})
-    has_desc = bool(desc_tag and desc_tag.get("content"))
+    has_desc = site["has_desc"]
     pts = 6 if has_desc else 0
     score += pts
     checks["有 Meta Description"] = (pts, has_desc)
 
-    h1 = soup.find("h1")
-    has_h1 = bool(h1 and h1.get_text(strip=True))
+    has_h1 = site["has_h1"]
     pts = 4 if has_h1 else 0
     score += pts
     checks["有 H1 标题"] = (pts, has_h1)
@@ -503,16 +1253,12 @@ def score_website_basic(url: str, html: Optional[str]) -> Dict[str, Any]:
     score += pts
     checks["文本量 ≥ 300 词"] = (pts, has_sufficient_text)
 
-    has_phone_text = any(x in texts for x in ["(", ")", "-", "+1"])
+    has_phone_text = bool(_PHONE_HINT_RE.search(texts))
     pts = 4 if has_phone_text else 0
     score += pts
     checks["页面上能看到电话"] = (pts, has_phone_text)
 
-    keywords = [
-        "chinese", "cantonese", "szechuan", "sichuan", "shanghai",
-        "dim sum", "noodle", "rice", "dumpling", "hot pot", "bbq"
-    ]
-    kw_hit = any(kw.lower() in texts.lower() for kw in keywords)
+    kw_hit = bool(_CUISINE_KW_RE.search(texts))
     pts = 6 if kw_hit else 0
     score += pts
     checks["文本包含菜品/菜系关键词"] = (pts, kw_hit)
@@ -532,34 +1278,55 @@ def score_website_basic(url: str, html: Optional[str]) -> Dict[str, Any]:
     }
 
 
-def estimate_revenue_loss(
-    monthly_search_volume: int,
-    rank_bucket: str,
-    avg_order_value: float,
-    channel: str = "dine-in",
-) -> float:
-    """粗略营收损失估算（内部 CTR/转化率假设）。"""
-    if channel == "delivery":
-        ctr = 0.18
-        conv = 0.35
-    else:
-        ctr = 0.12
-        conv = 0.25
+@st.cache_data(show_spinner=False)
+def checks_to_df(checks: tuple) -> pd.DataFrame:
+    """把评分检查项 ((名称, (得分, 是否达标)), ...) 转成展示用表格。"""
+    return pd.DataFrame(
+        [
+            {"检查项": name, "得分": pts, "是否达标": "✅ 是" if ok else "❌ 否"}
+            for name, (pts, ok) in checks
+        ]
+    )
+
+
+def build_competitors_df(
+    nearby_comp: List[Dict[str, Any]], exclude_place_id: str
+) -> pd.DataFrame:
+    """附近餐厅（去掉自己）按评分、评论数降序整理成竞对表。"""
+    rows = [
+        {
+            "name": r.get("name"),
+            "vicinity": r.get("vicinity"),
+            "rating": r.get("rating"),
+            "reviews": r.get("user_ratings_total"),
+            "place_id": r.get("place_id"),
+        }
+        for r in nearby_comp
+        if r.get("place_id") != exclude_place_id
+    ]
+    if not rows:
+        return pd.DataFrame(columns=["name", "vicinity", "rating", "reviews", "place_id"])
+    return pd.DataFrame(rows).sort_values(by=["rating", "reviews"], ascending=[False, False])
+
+
+# 渠道 → (CTR, 转化率)
+_CHANNEL_RATES: Dict[str, tuple] = {
+    "delivery": (0.18, 0.35),
+    "dine-in": (0.12, 0.25),
+}
+
+# 名次区间 → 流失比例（1 - 当前能拿到的客流占比）；none / unknown 全部流失
+_BUCKET_LOSS: Dict[str, float] = {
+    "top3": 0.0,
+    "4-10": 0.6,
+    "11+": 0.9,
+}
 
-    ideal_customers = monthly_search_volume * ctr * conv
-    if rank_bucket == "top3":
-        current_factor = 1.0
-    elif rank_bucket == "4-10":
-        current_factor = 0.4
-    elif rank_bucket == "11+":
-        current_factor = 0.1
-    else:  # none / unknown
-        current_factor = 0.0
 
-    current_customers = ideal_customers * current_factor
-    potential_extra_customers = ideal_customers - current_customers
-    monthly_loss = potential_extra_customers * avg_order_value
-    return monthly_loss
+def ideal_customers(monthly_search_volume: int, channel: str = "dine-in") -> float:
+    """排名第一时理论上每月能拿到的客人数。"""
+    ctr, conv = _CHANNEL_RATES.get(channel, _CHANNEL_RATES["dine-in"])
+    return monthly_search_volume * ctr * conv
 
 
 def infer_rank_from_serpapi(
@@ -567,61 +1334,169 @@ def infer_rank_from_serpapi(
 ) -> Optional[int]:
     """从 SerpAPI Google Maps 结果中找到当前餐厅名次。"""
     results = serp_json.get("local_results") or serp_json.get("places_results") or []
+    target = business_name.casefold()
+    if not target:
+        return None
     for idx, res in enumerate(results, start=1):
-        name = res.get("title") or res.get("name", "")
-        if name and business_name.lower() in name.lower():
+        name = res.get("title") or res.get("name") or ""
+        if target in name.casefold():
             return idx
     return None
 
+# 名次 → 区间：(0, 3] top3，(3, 10] 4-10，其余 11+；没找到为 none
+_RANK_BINS = [0, 3, 10, float("inf")]
+_RANK_LABELS = ["top3", "4-10", "11+"]
+
+
+def build_rank_df(
+    kw_list: List[str],
+    rank_lookup: Optional[Dict[str, Any]],
+    monthly_search_volume: int,
+    dine_in_aov: float,
+    delivery_aov: float,
+) -> pd.DataFrame:
+    """
+    把各关键词名次整理成“排名 & 损失”表，区间和损失整列一次算完。
+    rank_lookup 为 None（未配置 SerpAPI）或关键词超时的行，区间记为 unknown，损失留空。
+    """
+    ranks = rank_lookup["ranks"] if rank_lookup else {}
+    df = pd.DataFrame({"关键词": kw_list})
+    df["预估名次"] = pd.array([ranks.get(kw) for kw in kw_list], dtype="Int64")
+
+    if rank_lookup:
+        unknown = df["关键词"].isin(rank_lookup["timed_out"])
+    else:
+        unknown = pd.Series(True, index=df.index)
+
+    bucket = pd.cut(df["预估名次"], bins=_RANK_BINS, labels=_RANK_LABELS).astype(object)
+    df["名次区间"] = bucket.fillna("none").mask(unknown, "unknown")
+
+    loss_ratio = df["名次区间"].map(_BUCKET_LOSS).fillna(1.0).mask(unknown)
+    df["堂食月损失($)"] = (
+        loss_ratio * ideal_customers(monthly_search_volume, "dine-in") * dine_in_aov
+    ).round(1)
+    df["外卖月损失($)"] = (
+        loss_ratio * ideal_customers(monthly_search_volume, "delivery") * delivery_aov
+    ).round(1)
+    return df
+
+
+# 所有关键词排名查询的总等待上限（秒），超时的关键词按 unknown 处理
+SERPAPI_RANK_TIMEOUT_S = 10
+
+# 同时在途的 SerpAPI 请求数；线程池完成一个就补一个（滑动窗口），不是分批等齐
+SERPAPI_CONCURRENCY = 8
+
+
+def _serpapi_search_safe(
+    serpapi_key: str, keyword: str, lat: float, lng: float
+) -> Optional[Dict[str, Any]]:
+    """查询单个关键词的 Google Maps 结果，出错返回 None。"""
+    try:
+        return serpapi_google_maps_search(serpapi_key, keyword, lat, lng)
+    except Exception:
+        return None
+
+
+def fetch_keyword_ranks(
+    serpapi_key: str,
+    keywords: List[str],
+    lat: float,
+    lng: float,
+    business_name: str,
+    timeout_s: float = SERPAPI_RANK_TIMEOUT_S,
+) -> Dict[str, Any]:
+    """
+    并发查询多个关键词的名次：线程里只做网络请求，名次解析在收齐结果后统一进行。
+    返回 {"ranks": {关键词: 名次或 None}, "timed_out": 超时未返回的关键词集合}。
+    """
+    serp_results: Dict[str, Optional[Dict[str, Any]]] = {}
+    timed_out = set()
+    if not keywords:
+        return {"ranks": {}, "timed_out": timed_out}
+
+    # 不用 with：退出时会等所有线程结束，超时就失去意义
+    executor = ThreadPoolExecutor(max_workers=min(SERPAPI_CONCURRENCY, len(keywords)))
+    futures = {
+        executor.submit(_serpapi_search_safe, serpapi_key, kw, lat, lng): kw
+        for kw in keywords
+    }
+    try:
+        for fut in as_completed(futures, timeout=timeout_s):
+            serp_results[futures[fut]] = fut.result()
+    except FuturesTimeoutError:
+        for fut, kw in futures.items():
+            if not fut.done():
+                fut.cancel()
+                timed_out.add(kw)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    ranks = {
+        kw: infer_rank_from_serpapi(serp_json, business_name) if serp_json else None
+        for kw, serp_json in serp_results.items()
+    }
+    return {"ranks": ranks, "timed_out": timed_out}
+
 # =========================
 # 菜单相关 & 菜系画像
 # =========================
 
+# 只解析菜单提取会用到的标签，跳过 head / svg 等大块无关子树
+_MENU_NODES_XPATH = lxml.etree.XPath(
+    "descendant-or-self::*[self::h2 or self::h3 or self::h4 or self::li"
+    " or self::p or self::span or self::div]"
+)
+
+# 价格符号或常见菜品词，命中即视为菜单条目
+_MENU_KW_RE = re.compile(
+    r"[$¥]|chicken|beef|pork|noodle|rice|tofu|dumpling|soup", re.IGNORECASE
+)
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
 def extract_menu_text_from_html(html: str) -> str:
     """从 HTML 中尽量提取出像菜单的内容（菜名 + 价格等）"""
-    soup = BeautifulSoup(html, "lxml")
+    doc = _parse_html_doc(html)
+    if doc is None:
+        return ""
 
-    for tag in soup(["script", "style", "noscript"]):
-        tag.decompose()
+    for el in doc.xpath(".//script|.//style|.//noscript|.//comment()"):
+        el.drop_tree()
 
     texts = []
-    for el in soup.find_all(["h2", "h3", "h4", "li", "p", "span", "div"]):
-        txt = el.get_text(" ", strip=True)
+    for el in _MENU_NODES_XPATH(doc):
+        txt = " ".join(t.strip() for t in el.itertext() if t.strip())
         if not txt:
             continue
-        if any(x in txt for x in ["$", "¥"]) or any(
-            kw in txt.lower()
-            for kw in ["chicken", "beef", "pork", "noodle", "rice", "tofu", "dumpling", "soup"]
-        ):
-            if 3 <= len(txt) <= 120:
-                texts.append(txt)
+        if 3 <= len(txt) <= 120 and _MENU_KW_RE.search(txt):
+            texts.append(txt)
 
     if not texts:
-        full = soup.get_text(" ", strip=True)
+        full = " ".join(t.strip() for t in doc.itertext() if t.strip())
         return full[:4000]
 
-    seen = set()
-    deduped = []
-    for t in texts:
-        if t not in seen:
-            seen.add(t)
-            deduped.append(t)
-
+    deduped = list(dict.fromkeys(texts))
     return "\n".join(deduped[:400])
 
 
+@st.cache_data(show_spinner=False, ttl=3600)
 def build_menu_payload(menu_urls: List[str]) -> List[Dict[str, str]]:
-    menus: List[Dict[str, str]] = []
-    for url in menu_urls:
-        url = url.strip()
-        if not url:
-            continue
+    """并发抓取所有菜单链接（耗时取决于最慢的一个），再依次提取菜单文本。"""
+    urls = [u.strip() for u in menu_urls if u.strip()]
+    if not urls:
+        return []
 
-        html = fetch_html(url)
+    with ThreadPoolExecutor(max_workers=min(8, len(urls))) as ex:
+        htmls = list(ex.map(fetch_html, urls))
+
+    menus: List[Dict[str, str]] = []
+    for url, html in zip(urls, htmls):
+        source = urlparse(url).netloc or "unknown"
         if not html:
             menus.append(
                 {
-                    "source": urlparse(url).netloc or "unknown",
+                    "source": source,
                     "url": url,
                     "status": "fetch_failed_or_blocked",
                     "menu_text": "",
@@ -634,7 +1509,7 @@ def build_menu_payload(menu_urls: List[str]) -> List[Dict[str, str]]:
 
         menus.append(
             {
-                "source": urlparse(url).netloc or "unknown",
+                "source": source,
                 "url": url,
                 "status": status,
                 "menu_text": menu_text,
@@ -644,9 +1519,14 @@ def build_menu_payload(menu_urls: List[str]) -> List[Dict[str, str]]:
     return menus
 
 
-def discover_menu_urls(place_detail: Dict[str, Any], website_html: Optional[str]) -> List[str]:
+# 链接 / 锚文本里出现 menu、order（含 online order / order-online）即视为菜单链接
+_MENU_LINK_RE = re.compile(r"menu|order", re.IGNORECASE)
+
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def discover_menu_urls(place_detail: Dict[str, Any], site: Dict[str, Any]) -> List[str]:
     """
-    尝试自动发现菜单/点餐链接：
+    尝试自动发现菜单/点餐链接（site 为 parse_site 的结果）：
     - 自家官网
     - 官网页面里包含 menu/order 的链接
     - 常见第三方外卖平台链接
@@ -660,33 +1540,62 @@ def discover_menu_urls(place_detail: Dict[str, Any], website_html: Optional[str]
     if "url" in place_detail:
         urls.add(place_detail["url"])
 
-    if website_html:
-        soup = BeautifulSoup(website_html, "lxml")
-        for a in soup.find_all("a", href=True):
-            href = a["href"]
-            href_lower = href.lower()
-            text = a.get_text(" ", strip=True).lower()
-
-            if any(k in href_lower for k in ["menu", "order", "online-order", "order-online"]) or \
-               any(k in text for k in ["menu", "order", "online order"]):
-                urls.add(href)
-
-            for domain in [
-                "doordash.com",
-                "ubereats.com",
-                "grubhub.com",
-                "hungrypanda.co",
-                "fantuan.ca",
-                "order.online",
-                "chownow.com",
-            ]:
-                if domain in href_lower:
-                    urls.add(href)
+    for href, text in site.get("anchors", []):
+        if (
+            _MENU_LINK_RE.search(href)
+            or _DELIVERY_DOMAIN_RE.search(href)
+            or _MENU_LINK_RE.search(text)
+        ):
+            urls.add(href)
 
     return list(urls)
 
 # ========== 菜单菜系画像 & 精准竞对辅助函数 ==========
 
+# 菜系画像只需要看菜名分布，菜单文本超过这个 token 数就截断
+MENU_PROFILE_MAX_TOKENS = 6000
+# 没有 tiktoken 时每个 token 粗略按 2 个字符估算（中英混排菜单的保守值）
+_CHARS_PER_TOKEN = 2
+
+
+@st.cache_resource(show_spinner=False)
+def _get_token_encoding():
+    """gpt-4o / gpt-4.1 系列的 tokenizer；首次使用需下载词表，失败返回 None。"""
+    if not HAS_TIKTOKEN:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """把文本截断到不超过 max_tokens 个 token。"""
+    enc = _get_token_encoding()
+    if enc is None:
+        return text[: max_tokens * _CHARS_PER_TOKEN]
+    tokens = enc.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens])
+
+
+def combine_menu_texts(
+    menus_payload: List[Dict[str, str]], max_tokens: int = MENU_PROFILE_MAX_TOKENS
+) -> str:
+    """
+    合并所有来源的菜单文本：官网和 OCR 常常抓到同一份菜单，
+    按行去重（忽略大小写和首尾空白，保留首次出现的顺序），再截断到 token 上限。
+    """
+    lines: Dict[str, str] = {}
+    for m in menus_payload:
+        for line in (m.get("menu_text") or "").splitlines():
+            key = line.strip().casefold()
+            if key and key not in lines:
+                lines[key] = line.strip()
+    return truncate_to_tokens("\n".join(lines.values()), max_tokens)
+
+
 def analyze_menu_profile(menu_text: str) -> Dict[str, Any]:
     """
     用 ChatGPT 根据菜单文本做菜系画像（川菜 / 粤菜 / 港式茶餐厅 / 点心 / 奶茶店等）
@@ -723,16 +1632,31 @@ def analyze_menu_profile(menu_text: str) -> Dict[str, Any]:
 
     user_prompt = f"以下是这家餐厅的菜单内容（菜名+简介，可以不完整）：\n\n{menu_text}\n\n请根据上面的要求输出 JSON。"
 
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    cache_key = llm_cache_key("gpt-4.1-mini", messages, 0.2)
+    cached = disk_cache_get(cache_key, ttl_s=LLM_CACHE_TTL_S)
+    if cached is not None:
+        return cached
+
     resp = client.chat.completions.create(
         model="gpt-4.1-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
+        messages=messages,
         response_format={"type": "json_object"},
         temperature=0.2,
     )
-    return json.loads(resp.choices[0].message.content)
+    profile = json_loads(resp.choices[0].message.content)
+    disk_cache_set(cache_key, profile, ttl_s=LLM_CACHE_TTL_S)
+    return profile
+
+
+def _safe_place_details(api_key: str, place_id: str) -> Dict[str, Any]:
+    try:
+        return google_place_details(api_key, place_id, fields=COMPETITOR_DETAIL_FIELDS)
+    except Exception:
+        return {}
 
 
 def build_competitor_profiles(
@@ -742,22 +1666,20 @@ def build_competitor_profiles(
 ) -> List[Dict[str, Any]]:
     """
     将附近竞争对手的基础信息 + Google 详情整理成给 AI 用的简洁结构。
-    为控制调用次数，只取评分靠前的前 max_n 家。
+    为控制调用次数，只取评分靠前的前 max_n 家；详情请求并发发出。
     """
     profiles: List[Dict[str, Any]] = []
     if competitors_df is None or competitors_df.empty:
         return profiles
 
-    subset = competitors_df.head(max_n)
-    for _, row in subset.iterrows():
-        pid = row.get("place_id")
-        if not pid:
-            continue
-        try:
-            detail = google_place_details(api_key, pid)
-        except Exception:
-            detail = {}
+    rows = [row for _, row in competitors_df.head(max_n).iterrows() if row.get("place_id")]
+    if not rows:
+        return profiles
+
+    with ThreadPoolExecutor(max_workers=min(10, len(rows))) as ex:
+        details = list(ex.map(lambda r: _safe_place_details(api_key, r["place_id"]), rows))
 
+    for row, detail in zip(rows, details):
         profiles.append(
             {
                 "name": detail.get("name") or row.get("name"),
@@ -810,48 +1732,177 @@ def rank_competitors_with_gpt(
 }
     """.strip()
 
-    user_content = {
-        "target_profile": profile,
-        "candidates": candidates,
-    }
+    user_content = {
+        "target_profile": profile,
+        "candidates": candidates,
+    }
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": json_dumps(user_content)},
+    ]
+    cache_key = llm_cache_key("gpt-4.1-mini", messages, 0.3)
+    cached = disk_cache_get(cache_key, ttl_s=LLM_CACHE_TTL_S)
+    if cached is not None:
+        return cached
+
+    resp = client.chat.completions.create(
+        model="gpt-4.1-mini",
+        messages=messages,
+        response_format={"type": "json_object"},
+        temperature=0.3,
+    )
+
+    data = json_loads(resp.choices[0].message.content)
+    competitors = data.get("competitors", [])
+    if competitors:
+        disk_cache_set(cache_key, competitors, ttl_s=LLM_CACHE_TTL_S)
+    return competitors
+
+# =========================
+# ChatGPT 深度分析函数
+# =========================
+
+# 深度分析报告的输出上限：五个部分每部分约 800–1200 个汉字（o200k 词表下中文约 1 token/字），
+# 合计 5000 左右，再留余量；超过上限时在报告末尾提示被截断
+DEEP_ANALYSIS_MAX_TOKENS = 8000
+
+
+def stream_llm_safe(messages: List[Dict[str, Any]], max_tokens: Optional[int] = None) -> Iterator[str]:
+    """
+    按 LLM_MODEL_CHAIN 依次尝试模型，流式调用 ChatGPT，边生成边 yield 文本片段。
+    第一个片段出来之前出错就换下一个模型；已经开始输出后出错则附上错误说明并结束；
+    因达到 max_tokens 而停止时在末尾附上截断提示。
+    只有正常结束（finish_reason == "stop"）的结果才落盘缓存，同样的请求再次调用时一次性返回缓存文本。
+    """
+    if client is None:
+        yield "未配置 OPENAI_API_KEY，无法调用 ChatGPT，请在 Streamlit Secrets 中添加 OPENAI_API_KEY。"
+        return
+
+    cache_key = llm_cache_key(LLM_MODEL_CHAIN, messages, 0.4, max_tokens)
+    cached = disk_cache_get(cache_key, ttl_s=LLM_CACHE_TTL_S)
+    if cached is not None:
+        yield cached
+        return
+
+    errors = []
+    for model in LLM_MODEL_CHAIN:
+        started = False
+        parts: List[str] = []
+        try:
+            stream = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.4,
+                max_tokens=max_tokens,
+                stream=True,
+            )
+            finish_reason = None
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    started = True
+                    parts.append(delta)
+                    yield delta
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+            if parts and finish_reason == "length":
+                # 截断的报告只提示不落盘，否则 7 天内每次都重放这份不完整的结果
+                yield "\n\n（内容达到长度上限，报告在此处被截断。）"
+            if parts and finish_reason == "stop":
+                disk_cache_set(cache_key, "".join(parts), ttl_s=LLM_CACHE_TTL_S)
+            return
+        except Exception as e:
+            if started:
+                yield f"\n\n（生成中断：{e}）"
+                return
+            errors.append(f"{model} 错误：{e}")
+    yield "调用 ChatGPT 失败。\n" + "\n".join(errors)
+
+
+# 深度分析的角色设定和任务说明全部放在固定的 system 消息里，每次请求的前缀完全相同，
+# 可以命中 OpenAI 的自动 prompt 缓存；每家店不同的数据放在后面的 user 消息里。
+# 自动缓存只对 1024 token 以上的前缀生效，所以把完整的输出格式也写进来
+# （cl100k_base 下约 1900 token，o200k_base 下中文更省，仍明显超过 1024）。
+_DEEP_ANALYSIS_SYSTEM_PROMPT = """
+你是一名专门服务北美餐馆的本地营销和外卖运营顾问，曾任职于麦肯锡一个专门做餐饮分析的部门，非常了解世界各地的菜系，尤其在中餐菜系的细分领域属于行业权威，如粤菜、茶餐厅、川菜、湘菜、东北菜、上海菜等，熟悉 Google 本地搜索和 UberEats/DoorDash/Grubhub/Hungrypanda/Fantuan 等平台的运营逻辑。请用简体中文回答，但在需要时可加少量英文术语。
+
+用户会提供一个餐厅的在线数据（结构化数据 JSON）和菜单片段、网站文本片段，请你做**多维深度分析**。
+
+请你完成以下任务（分段输出）：
+
+1. **菜系细分判断**
+   - 判断该店的主菜系和子菜系（例如：粤菜-茶餐厅、川菜-辣炒、东北家常菜、上海菜等），说明依据。
+   - 如果菜单里有多种菜系，请说明主次结构。
+
+2. **菜单结构与价格带分析**
+   - 根据菜单文本，分析：
+     - 热门品类（如主食类、招牌菜、套餐、炸鸡、甜品等）
+     - 人均价位区间、主力价格带（例如：多数主菜集中在 $15–$22）
+     - 是否存在明显的“利润杀手”（价格偏低但制作复杂、毛利低的菜）。
+
+3. **线上曝光 & 竞争态势解读**
+   - 结合 GBP 评分、网站得分、关键词排名结果，判断：
+     - 目前在本地搜索中的位置（落后程度、有无机会冲击 Top 3）。
+     - 和 3–5 家核心竞品相比的明显短板和优势。
+
+4. **外卖平台机会点（如果菜单里出现外卖平台链接）**
+   - 根据菜品结构和价格，判断适合重点发力的平台类型（聚合外卖 / 自配送 / 线下堂食引流）。
+   - 给出 2–3 个具体可执行的促销活动建议（比如：高毛利品类做 BOGO、午市定价逻辑等）。
+
+5. **接下来 30 天可执行的行动清单**
+   - 用清单方式给出 5–8 条“餐馆老板能听懂、能马上执行”的改进建议：
+     - Google 资料 & 网站内容优先级；
+     - 菜单结构和定价优化；
+     - 外卖活动 & 转化率优化建议。
+
+要求：
+- 尽量用短句和项目符号，方便餐厅老板阅读和执行。
+- 对每条建议，简单说明“为什么这么做有用”（基于数据/经验的逻辑）。
+
+输出格式（Markdown，严格按以下结构，不要输出开场白和结束语）：
+
+## 1. 菜系细分判断
+- **主菜系 / 子菜系**：一句话结论。
+- **判断依据**：2–4 条，每条引用菜单或数据里的具体菜名、关键词或字段。
+- **菜系结构**：有多种菜系时写“主：xx（约 x 成）/ 次：xx”，只有一种时写“单一菜系”。
+
+## 2. 菜单结构与价格带分析
+- **热门品类**：按重要性列 3–6 个品类，每个品类后括号里举 1–2 道代表菜。
+- **价格带**：用下表给出，价格一律写成美元区间（如 $15–$22），菜单没有价格时整表写“数据不足”：
+
+| 品类 | 价格区间 | 主力价格带 | 备注 |
+| --- | --- | --- | --- |
+
+- **利润杀手**：列出 0–3 道，每道写“菜名 — 问题 — 建议（提价 / 改规格 / 下架 / 做套餐）”；没有明显的就写“未发现”。
 
-    resp = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": json.dumps(user_content, ensure_ascii=False)},
-        ],
-        response_format={"type": "json_object"},
-        temperature=0.3,
-    )
+## 3. 线上曝光 & 竞争态势解读
+- **本地搜索位置**：结合关键词排名逐个关键词给结论（Top 3 / 4–10 / 10 名以外 / 未上榜）。
+- **GBP 与网站**：各用一句话点出最影响排名的 1–2 个扣分项。
+- **竞品对比**：用下表对比 3–5 家核心竞品，优势和短板都要写具体（评分、评论数、菜系、价位）：
 
-    data = json.loads(resp.choices[0].message.content)
-    return data.get("competitors", [])
+| 竞品 | 评分 / 评论数 | 相对我们的优势 | 相对我们的短板 |
+| --- | --- | --- | --- |
 
-# =========================
-# ChatGPT 深度分析函数
-# =========================
+## 4. 外卖平台机会点
+- **平台策略**：聚合外卖 / 自配送 / 堂食引流中选出重点，说明原因。
+- **促销活动**：2–3 个，每个写“活动内容 — 适用菜品 — 预期作用 — 注意事项（毛利、平台抽成）”。
+- 数据里没有外卖相关信息时，本部分写“未发现外卖平台信息”，再给出 1–2 条入驻外卖平台的建议。
 
-def call_llm_safe(messages: List[Dict[str, Any]]) -> str:
-    if client is None:
-        return "未配置 OPENAI_API_KEY，无法调用 ChatGPT，请在 Streamlit Secrets 中添加 OPENAI_API_KEY。"
-    try:
-        completion = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=messages,
-            temperature=0.4,
-        )
-        return completion.choices[0].message.content
-    except Exception as e:
-        try:
-            completion = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                temperature=0.4,
-            )
-            return completion.choices[0].message.content
-        except Exception as e2:
-            return f"调用 ChatGPT 失败。\n主模型错误：{e}\n备用模型错误：{e2}"
+## 5. 接下来 30 天可执行的行动清单
+按优先级编号列出 5–8 条，每条固定格式：
+1. **动作**：要做的具体事情（谁来做、做到什么程度）
+   - 为什么：对应的数据或经验依据
+   - 预计耗时：x 小时 / x 天
+   - 预期效果：可以观察到的变化（如评论数、排名、外卖单量）
+
+通用规则：
+- 只根据用户提供的数据下结论；某项数据缺失时明确写“数据不足”，不要编造数字、竞品或菜品。
+- 金额统一用美元并带 $ 符号，评分保留一位小数，百分比写成整数。
+- 菜名保留菜单原文，必要时在括号里补充中文或英文名。
+- 每个部分控制在 300–1200 字以内，先写结论再写依据。
+""".strip()
 
 
 def llm_deep_analysis(
@@ -864,7 +1915,8 @@ def llm_deep_analysis(
     dine_in_aov: float,
     delivery_aov: float,
     menus_payload: List[Dict[str, str]],
-) -> str:
+) -> Iterator[str]:
+    """生成深度分析报告，按文本片段流式返回（配合 st.write_stream 边出边显示）。"""
     comp_json = []
     if competitors_df is not None and not competitors_df.empty:
         sub = competitors_df.head(6)
@@ -897,59 +1949,157 @@ def llm_deep_analysis(
 
     text_snippet = web_result.get("text_snippet", "")
 
-    system_msg = (
-        "你是一名专门服务北美餐馆的本地营销和外卖运营顾问，曾任职于麦肯锡一个专门做餐饮分析的部门，"
-        "非常了解世界各地的菜系，尤其在中餐菜系的细分领域属于行业权威，如粤菜、茶餐厅、川菜、湘菜、东北菜、上海菜等，"
-        "熟悉 Google 本地搜索和 UberEats/DoorDash/Grubhub/Hungrypanda/Fantuan 等平台的运营逻辑。"
-        "请用简体中文回答，但在需要时可加少量英文术语。"
-    )
-
     user_msg = f"""
-这是一个餐厅的在线数据和菜单片段，请你做**多维深度分析**：
+以下是这家餐厅的在线数据和菜单片段，请按要求完成多维深度分析。
 
 【结构化数据 JSON】
-{json.dumps(payload, ensure_ascii=False, indent=2)}
+{json_dumps(payload, indent=True)}
 
 【网站文本片段（最多 3000 字符）】
 {text_snippet}
+"""
 
-请你完成以下任务（分段输出）：
+    messages = [
+        {"role": "system", "content": _DEEP_ANALYSIS_SYSTEM_PROMPT},
+        {"role": "user", "content": user_msg},
+    ]
+    return stream_llm_safe(messages, max_tokens=DEEP_ANALYSIS_MAX_TOKENS)
 
-1. **菜系细分判断**
-   - 判断该店的主菜系和子菜系（例如：粤菜-茶餐厅、川菜-辣炒、东北家常菜、上海菜等），说明依据。
-   - 如果菜单里有多种菜系，请说明主次结构。
+# =========================
+# 按钮触发的局部区块（st.fragment）
+# =========================
+# 点击区块内的按钮只重跑该区块，不再从头执行上面的 Google / SerpAPI / 官网抓取。
+# OCR 结果写进 session_state，AI 区块在点击时再读取，因此不依赖整页重跑。
 
-2. **菜单结构与价格带分析**
-   - 根据菜单文本，分析：
-     - 热门品类（如主食类、招牌菜、套餐、炸鸡、甜品等）
-     - 人均价位区间、主力价格带（例如：多数主菜集中在 $15–$22）
-     - 是否存在明显的“利润杀手”（价格偏低但制作复杂、毛利低的菜）。
 
-3. **线上曝光 & 竞争态势解读**
-   - 结合 GBP 评分、网站得分、关键词排名结果，判断：
-     - 目前在本地搜索中的位置（落后程度、有无机会冲击 Top 3）。
-     - 和 3–5 家核心竞品相比的明显短板和优势。
+def with_ocr_menus(menus_payload: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """在菜单链接抓取结果后面追加 session_state 里的 OCR 菜单文本（作为额外来源）。"""
+    ocr_texts = st.session_state.get("ocr_menu_texts", [])
+    return menus_payload + [
+        {
+            "source": f"google_menu_photo_{idx}",
+            "url": "",
+            "status": "ocr_ok",
+            "menu_text": txt,
+        }
+        for idx, txt in enumerate(ocr_texts, start=1)
+    ]
 
-4. **外卖平台机会点（如果菜单里出现外卖平台链接）**
-   - 根据菜品结构和价格，判断适合重点发力的平台类型（聚合外卖 / 自配送 / 线下堂食引流）。
-   - 给出 2–3 个具体可执行的促销活动建议（比如：高毛利品类做 BOGO、午市定价逻辑等）。
 
-5. **接下来 30 天可执行的行动清单**
-   - 用清单方式给出 5–8 条“餐馆老板能听懂、能马上执行”的改进建议：
-     - Google 资料 & 网站内容优先级；
-     - 菜单结构和定价优化；
-     - 外卖活动 & 转化率优化建议。
+@st.fragment
+def menu_ocr_section(menu_photos: List[Dict[str, Any]]) -> None:
+    auto_ocr_btn = st.button("🧾 自动对菜单页做 OCR 并提取菜单文本")
 
-要求：
-- 尽量用短句和项目符号，方便餐厅老板阅读和执行。
-- 对每条建议，简单说明“为什么这么做有用”（基于数据/经验的逻辑）。
-"""
+    if auto_ocr_btn:
+        if client is None:
+            st.error("未配置 OPENAI_API_KEY，无法进行 OCR。")
+        else:
+            progress = st.progress(0.0, text="AI 正在识别菜单页中的菜名和价格…")
+            ocr_results = ocr_menu_photos(
+                menu_photos,
+                on_progress=lambda done, total: progress.progress(
+                    done / total, text=f"AI 正在识别菜单页中的菜名和价格…（{done}/{total}）"
+                ),
+            )
+            progress.empty()
+
+            if ocr_results:
+                st.session_state["ocr_menu_texts"] = ocr_results
+                st.success(f"从菜单页图片中提取出 {len(ocr_results)} 段菜单文本。")
+                for idx, txt in enumerate(ocr_results, start=1):
+                    st.markdown(f"**OCR 菜单 #{idx}：**")
+                    st.code(txt, language="text")
+            else:
+                st.warning("自动识别的菜单页中没有提取出有效菜单文本。")
+
+
+@st.fragment
+def ai_competitor_section(
+    menus_payload: List[Dict[str, str]], competitors_df: Optional[pd.DataFrame]
+) -> None:
+    st.markdown("### 🍜 基于菜单菜系画像的精准竞对（实验功能）")
+
+    ai_comp_btn = st.button("✨ 生成菜系画像 + 精准竞对列表")
+
+    if ai_comp_btn:
+        if client is None:
+            st.error("未配置 OPENAI_API_KEY，无法进行菜系画像和竞对筛选。")
+        else:
+            combined_menu_text = combine_menu_texts(with_ocr_menus(menus_payload))
+
+            if not combined_menu_text.strip():
+                st.warning("当前未能成功获取任何菜单文本，无法进行菜系画像。请检查菜单链接或菜单图片 OCR。")
+            else:
+                with st.spinner("AI 正在根据菜单生成菜系画像…"):
+                    profile = analyze_menu_profile(combined_menu_text)
+
+                if "error" in profile:
+                    st.error(profile["error"])
+                else:
+                    st.subheader("🔎 AI 菜系画像")
+                    st.json(profile)
+
+                    if competitors_df is None or competitors_df.empty:
+                        st.info("附近竞争对手数据不足，无法进一步筛选真正竞对。")
+                    else:
+                        with st.spinner("AI 正在基于菜系画像筛选真正的核心竞对…"):
+                            candidate_profiles = build_competitor_profiles(
+                                competitors_df, GOOGLE_API_KEY, max_n=15
+                            )
+                            ranked_competitors = rank_competitors_with_gpt(
+                                profile, candidate_profiles
+                            )
+
+                        if not ranked_competitors:
+                            st.warning("AI 未能返回有效的竞对列表，可能是信息太少或模型调用出错。")
+                        else:
+                            st.subheader("🏆 AI 判定的核心竞对（按相似度排序）")
+                            ranked_df = pd.DataFrame(ranked_competitors)
+                            st.dataframe(ranked_df, use_container_width=True)
+
+
+@st.fragment
+def ai_report_section(
+    place_detail: Dict[str, Any],
+    gbp_result: Dict[str, Any],
+    web_result: Dict[str, Any],
+    competitors_df: Optional[pd.DataFrame],
+    rank_rows: List[Dict[str, Any]],
+    monthly_search_volume: int,
+    dine_in_aov: float,
+    delivery_aov: float,
+    menus_payload: List[Dict[str, str]],
+) -> None:
+    st.markdown("### 🧠 生成 ChatGPT 菜系 & 菜单 & 运营深度分析报告")
+
+    ai_btn = st.button("📊 生成 AI 深度分析报告（长文版）")
+
+    if ai_btn:
+        st.info("已收到生成请求，正在调用 ChatGPT ...")
+
+        if client is None:
+            st.error("当前未配置 OPENAI_API_KEY，无法调用 ChatGPT，请在 Streamlit Secrets 中添加 OPENAI_API_KEY。")
+        else:
+            import traceback
+
+            try:
+                st.write_stream(
+                    llm_deep_analysis(
+                        place_detail=place_detail,
+                        gbp_result=gbp_result,
+                        web_result=web_result,
+                        competitors_df=competitors_df,
+                        rank_results=rank_rows,
+                        monthly_search_volume=monthly_search_volume,
+                        dine_in_aov=dine_in_aov,
+                        delivery_aov=delivery_aov,
+                        menus_payload=with_ocr_menus(menus_payload),
+                    )
+                )
+            except Exception as e:
+                st.error(f"调用 ChatGPT 时发生未捕获错误：{e}")
+                st.code(traceback.format_exc())
 
-    messages = [
-        {"role": "system", "content": system_msg},
-        {"role": "user", "content": user_msg},
-    ]
-    return call_llm_safe(messages)
 
 # =========================
 # 1️⃣ 输入地址，锁定餐厅
@@ -977,9 +2127,22 @@ if search_btn:
                 loc = geocode_res[0]["geometry"]["location"]
                 lat = loc["lat"]
                 lng = loc["lng"]
-                nearby = google_places_nearby(
-                    GOOGLE_API_KEY, lat, lng, radius_m=300, type_="restaurant"
+                nearby_wide = google_places_nearby(
+                    GOOGLE_API_KEY, lat, lng, radius_m=COMPETITOR_RADIUS_M, type_="restaurant"
                 )
+                st.session_state["nearby_cache"] = {
+                    "lat": lat,
+                    "lng": lng,
+                    "results": nearby_wide,
+                }
+                if len(nearby_wide) < PLACES_NEARBY_PAGE_SIZE:
+                    # 大半径结果没被截断，本地按距离筛即为完整候选列表
+                    nearby = filter_places_within(nearby_wide, lat, lng, CANDIDATE_RADIUS_M)
+                else:
+                    # 大半径结果按知名度截断（最多 20 家），小店会被挤掉，候选列表单独按小半径查
+                    nearby = google_places_nearby(
+                        GOOGLE_API_KEY, lat, lng, radius_m=CANDIDATE_RADIUS_M, type_="restaurant"
+                    )
                 if not nearby:
                     st.warning("附近 300 米内未找到餐厅，请尝试输入更精确的地址或放大范围。")
                 else:
@@ -1056,6 +2219,7 @@ if candidate_places:
 
     if run_btn:
         st.session_state["analysis_ready"] = True
+        st.session_state["analysis_memo"] = {}
 else:
     st.info("先输入地址并点击“根据地址查找附近餐厅”。")
 
@@ -1066,8 +2230,12 @@ else:
 if candidate_places and selected_place_id and (
     run_btn or st.session_state.get("analysis_ready", False)
 ):
-    with st.spinner("获取餐厅详情（Google Place Details）..."):
-        place_detail = google_place_details(GOOGLE_API_KEY, selected_place_id)
+    place_detail = session_memo(
+        ("place_detail", selected_place_id),
+        lambda: google_place_details(GOOGLE_API_KEY, selected_place_id),
+        spinner="获取餐厅详情（Google Place Details）...",
+        persist=True,
+    )
 
     st.success(f"已锁定餐厅：**{place_detail.get('name', 'Unknown')}**")
 
@@ -1076,117 +2244,91 @@ if candidate_places and selected_place_id and (
     center_lat = location.get("lat")
     center_lng = location.get("lng")
 
-    with st.spinner("扫描附近 1.5 公里内的竞争对手..."):
-        nearby_comp = google_places_nearby(
-            GOOGLE_API_KEY, center_lat, center_lng, radius_m=1500, type_="restaurant"
-        )
-
-    competitors_rows = []
-    for r in nearby_comp:
-        pid = r.get("place_id")
-        if pid == selected_place_id:
-            continue
-        competitors_rows.append(
-            {
-                "name": r.get("name"),
-                "vicinity": r.get("vicinity"),
-                "rating": r.get("rating"),
-                "reviews": r.get("user_ratings_total"),
-                "place_id": pid,
-            }
-        )
+    website_url = website_override.strip() or place_detail.get("website", "")
+    kw_list = [k.strip() for k in keywords_input.split(",") if k.strip()]
 
-    competitors_df = pd.DataFrame(competitors_rows).sort_values(
-        by=["rating", "reviews"], ascending=[False, False]
+    # 搜索阶段已按 1.5 公里查过一次（中心点与所选餐厅相距不超过 300 米），直接复用
+    nearby_cache = st.session_state.get("nearby_cache")
+    competitors_key = ("competitors_df", selected_place_id)
+    load_competitors = lambda: build_competitors_df(
+        nearby_cache["results"]
+        if nearby_cache
+        else google_places_nearby(
+            GOOGLE_API_KEY, center_lat, center_lng, radius_m=COMPETITOR_RADIUS_M, type_="restaurant"
+        ),
+        selected_place_id,
     )
+    rank_key = ("rank_lookup", selected_place_id, tuple(kw_list))
+    can_rank = bool(kw_list and SERPAPI_KEY and center_lat and center_lng)
+    load_ranks = lambda: fetch_keyword_ranks(
+        SERPAPI_KEY, kw_list, center_lat, center_lng, place_detail.get("name", "")
+    )
+    persist_ranks = lambda lookup: not lookup["timed_out"]
+    photos_key = ("menu_photos", selected_place_id)
+    load_photos = lambda: get_place_photos(place_detail, max_photos=20)
+
+    # 竞对扫描、关键词排名、菜单图片识别都只依赖餐厅详情：先放到后台线程，和官网抓取同时进行
+    prefetch_ex = ThreadPoolExecutor(max_workers=3)
+    session_prefetch(prefetch_ex, competitors_key, load_competitors)
+    if can_rank:
+        session_prefetch(prefetch_ex, rank_key, load_ranks, persist=persist_ranks)
+    session_prefetch(prefetch_ex, photos_key, load_photos, persist=True)
+    prefetch_ex.shutdown(wait=False)
 
-    gbp_result = score_gbp_profile(place_detail)
-
-    website_url = website_override.strip() or place_detail.get("website", "")
     website_html = None
     if website_url:
-        with st.spinner("抓取官网页面用于分析..."):
-            website_html = fetch_html(website_url)
+        website_html = session_memo(
+            ("website_html", website_url),
+            lambda: fetch_html(website_url),
+            spinner="抓取官网页面用于分析...",
+        )
 
-    web_result = score_website_basic(website_url, website_html)
+    competitors_df = session_memo(
+        competitors_key, load_competitors, spinner="扫描附近 1.5 公里内的竞争对手..."
+    )
 
-    st.markdown("## 3️⃣ 关键词排名 & 潜在营收损失（粗略估算）")
+    gbp_result = score_gbp_profile(place_detail)
 
-    kw_list = [k.strip() for k in keywords_input.split(",") if k.strip()]
-    rank_rows: List[Dict[str, Any]] = []
+    website_site = parse_site(website_html)
+    web_result = score_website_basic(website_url, website_site)
 
-    if SERPAPI_KEY and center_lat and center_lng:
-        with st.spinner("通过 SerpAPI 查询 Google Maps 排名..."):
-            for kw in kw_list:
-                try:
-                    serp_json = serpapi_google_maps_search(
-                        SERPAPI_KEY, kw, center_lat, center_lng
-                    )
-                    rank = infer_rank_from_serpapi(serp_json, place_detail.get("name", ""))
-                except Exception:
-                    rank = None
-
-                if rank is None:
-                    bucket = "none"
-                elif rank <= 3:
-                    bucket = "top3"
-                elif rank <= 10:
-                    bucket = "4-10"
-                else:
-                    bucket = "11+"
+    st.markdown("## 3️⃣ 关键词排名 & 潜在营收损失（粗略估算）")
 
-                dine_loss = estimate_revenue_loss(
-                    monthly_search_volume, bucket, dine_in_aov, channel="dine-in"
-                )
-                delivery_loss = estimate_revenue_loss(
-                    monthly_search_volume, bucket, delivery_aov, channel="delivery"
-                )
+    rank_lookup: Optional[Dict[str, Any]] = None
 
-                rank_rows.append(
-                    {
-                        "关键词": kw,
-                        "预估名次": rank,
-                        "名次区间": bucket,
-                        "堂食月损失($)": round(dine_loss, 1),
-                        "外卖月损失($)": round(delivery_loss, 1),
-                    }
-                )
+    if not kw_list:
+        st.info("未填写核心关键词，跳过 Google Maps 排名查询。")
+    elif can_rank:
+        rank_lookup = session_memo(
+            rank_key,
+            load_ranks,
+            spinner="通过 SerpAPI 查询 Google Maps 排名...",
+            persist=persist_ranks,
+        )
+        if rank_lookup["timed_out"]:
+            st.warning(
+                f"{len(rank_lookup['timed_out'])} 个关键词在 {SERPAPI_RANK_TIMEOUT_S} 秒内未返回排名，已标记为 unknown。"
+            )
     else:
         st.warning("未配置 SERPAPI_KEY，无法自动查询 Google Maps 排名，仅展示关键词列表。")
-        for kw in kw_list:
-            rank_rows.append(
-                {
-                    "关键词": kw,
-                    "预估名次": None,
-                    "名次区间": "unknown",
-                    "堂食月损失($)": None,
-                    "外卖月损失($)": None,
-                }
-            )
 
-    rank_df = pd.DataFrame(rank_rows)
+    rank_df = build_rank_df(
+        kw_list, rank_lookup, monthly_search_volume, dine_in_aov, delivery_aov
+    )
+    # 给 LLM 的 payload 需要原生 Python 类型（NA → None）
+    rank_rows = rank_df.astype(object).where(rank_df.notna(), None).to_dict("records")
     st.dataframe(rank_df, use_container_width=True)
 
     st.markdown("## 4️⃣ Google 商家资料健康状况（Profile）")
 
     st.write(f"**Profile 评分：{gbp_result['score']} / 40**")
-    gbp_checks_df = pd.DataFrame(
-        [
-            {"检查项": name, "得分": pts, "是否达标": "✅ 是" if ok else "❌ 否"}
-            for name, (pts, ok) in gbp_result["checks"].items()
-        ]
-    )
+    gbp_checks_df = checks_to_df(tuple(gbp_result["checks"].items()))
     st.dataframe(gbp_checks_df, use_container_width=True)
 
     st.markdown("## 5️⃣ 官网内容 & 结构健康状况（Website）")
 
     st.write(f"**网站评分：{web_result['score']} / 40**")
-    web_checks_df = pd.DataFrame(
-        [
-            {"检查项": name, "得分": pts, "是否达标": "✅ 是" if ok else "❌ 否"}
-            for name, (pts, ok) in web_result["checks"].items()
-        ]
-    )
+    web_checks_df = checks_to_df(tuple(web_result["checks"].items()))
     st.dataframe(web_checks_df, use_container_width=True)
 
     if website_url:
@@ -1220,38 +2362,22 @@ if candidate_places and selected_place_id and (
     # =============================
     st.markdown("## 8️⃣ Google 菜单图片 → 自动 OCR 提取菜品及价格（可选）")
 
-    menu_photos = get_place_photos(place_detail, max_photos=20)
+    menu_photos = session_memo(photos_key, load_photos, persist=True)
 
     if not menu_photos:
         st.info("没有从 Google 图片中自动识别出菜单页，将跳过图片 OCR。")
     else:
         st.write(f"已从 Google 图片中自动识别出 {len(menu_photos)} 张可能是菜单页的图片：")
-        cols = st.columns(4)
-        for i, item in enumerate(menu_photos):
-            with cols[i % 4]:
-                st.image(item["image_bytes"], use_column_width=True)
-
-        auto_ocr_btn = st.button("🧾 自动对菜单页做 OCR 并提取菜单文本")
+        thumbs = session_memo(
+            ("menu_thumbs", selected_place_id),
+            lambda: [
+                _prepare_image(item["image_bytes"], PREVIEW_IMAGE_MAX_SIDE, 75)
+                for item in menu_photos
+            ],
+        )
+        st.image(thumbs, width=PREVIEW_IMAGE_MAX_SIDE)
 
-        if auto_ocr_btn:
-            if client is None:
-                st.error("未配置 OPENAI_API_KEY，无法进行 OCR。")
-            else:
-                ocr_results = []
-                with st.spinner("AI 正在识别菜单页中的菜名和价格…"):
-                    for item in menu_photos:
-                        text = ocr_menu_from_image_bytes(item["image_bytes"])
-                        if text:
-                            ocr_results.append(text)
-
-                if ocr_results:
-                    st.session_state["ocr_menu_texts"] = ocr_results
-                    st.success(f"从菜单页图片中提取出 {len(ocr_results)} 段菜单文本。")
-                    for idx, txt in enumerate(ocr_results, start=1):
-                        st.markdown(f"**OCR 菜单 #{idx}：**")
-                        st.code(txt, language="text")
-                else:
-                    st.warning("自动识别的菜单页中没有提取出有效菜单文本。")
+        menu_ocr_section(menu_photos)
 
     # =============================
     # 9️⃣ 菜单抓取（官网/外卖链接）+ 合并 OCR 菜单
@@ -1259,7 +2385,7 @@ if candidate_places and selected_place_id and (
 
     st.markdown("## 9️⃣ 菜单抓取 & AI 菜系 / 菜单结构分析")
 
-    auto_menu_urls = discover_menu_urls(place_detail, website_html)
+    auto_menu_urls = discover_menu_urls(place_detail, website_site)
     auto_menu_urls_str = "\n".join(auto_menu_urls)
 
     st.markdown("#### 菜单链接抓取（可手动增删）")
@@ -1292,89 +2418,19 @@ if candidate_places and selected_place_id and (
     else:
         st.info("当前没有可用的菜单链接，AI 分析将主要基于 Google 资料和官网内容。")
 
-    # 把 OCR 出来的菜单文本也塞进 menus_payload（作为额外来源）
-    ocr_texts = st.session_state.get("ocr_menu_texts", [])
-    for idx, txt in enumerate(ocr_texts, start=1):
-        menus_payload.append(
-            {
-                "source": f"google_menu_photo_{idx}",
-                "url": "",
-                "status": "ocr_ok",
-                "menu_text": txt,
-            }
-        )
-
-    # ========== 基于菜单菜系画像的精准竞对模块 ==========
-    st.markdown("### 🍜 基于菜单菜系画像的精准竞对（实验功能）")
-
-    ai_comp_btn = st.button("✨ 生成菜系画像 + 精准竞对列表")
-
-    if ai_comp_btn:
-        if client is None:
-            st.error("未配置 OPENAI_API_KEY，无法进行菜系画像和竞对筛选。")
-        else:
-            combined_menu_text_parts = [m["menu_text"] for m in menus_payload if m.get("menu_text")]
-            combined_menu_text = "\n".join(combined_menu_text_parts)
-
-            if not combined_menu_text.strip():
-                st.warning("当前未能成功获取任何菜单文本，无法进行菜系画像。请检查菜单链接或菜单图片 OCR。")
-            else:
-                with st.spinner("AI 正在根据菜单生成菜系画像…"):
-                    profile = analyze_menu_profile(combined_menu_text)
-
-                if "error" in profile:
-                    st.error(profile["error"])
-                else:
-                    st.subheader("🔎 AI 菜系画像")
-                    st.json(profile)
-
-                    if competitors_df is None or competitors_df.empty:
-                        st.info("附近竞争对手数据不足，无法进一步筛选真正竞对。")
-                    else:
-                        with st.spinner("AI 正在基于菜系画像筛选真正的核心竞对…"):
-                            candidate_profiles = build_competitor_profiles(
-                                competitors_df, GOOGLE_API_KEY, max_n=15
-                            )
-                            ranked_competitors = rank_competitors_with_gpt(
-                                profile, candidate_profiles
-                            )
-
-                        if not ranked_competitors:
-                            st.warning("AI 未能返回有效的竞对列表，可能是信息太少或模型调用出错。")
-                        else:
-                            st.subheader("🏆 AI 判定的核心竞对（按相似度排序）")
-                            ranked_df = pd.DataFrame(ranked_competitors)
-                            st.dataframe(ranked_df, use_container_width=True)
-
-    st.markdown("### 🧠 生成 ChatGPT 菜系 & 菜单 & 运营深度分析报告")
-
-    ai_btn = st.button("📊 生成 AI 深度分析报告（长文版）")
-
-    if ai_btn:
-        st.info("已收到生成请求，正在调用 ChatGPT ...")
-
-        if client is None:
-            st.error("当前未配置 OPENAI_API_KEY，无法调用 ChatGPT，请在 Streamlit Secrets 中添加 OPENAI_API_KEY。")
-        else:
-            import traceback
-
-            with st.spinner("正在调用 ChatGPT 生成分析报告…"):
-                try:
-                    ai_report = llm_deep_analysis(
-                        place_detail=place_detail,
-                        gbp_result=gbp_result,
-                        web_result=web_result,
-                        competitors_df=competitors_df,
-                        rank_results=rank_rows,
-                        monthly_search_volume=monthly_search_volume,
-                        dine_in_aov=dine_in_aov,
-                        delivery_aov=delivery_aov,
-                        menus_payload=menus_payload,
-                    )
-                    st.markdown(ai_report)
-                except Exception as e:
-                    st.error(f"调用 ChatGPT 时发生未捕获错误：{e}")
-                    st.code(traceback.format_exc())
+    ai_competitor_section(menus_payload, competitors_df)
+
+    ai_report_section(
+        place_detail=place_detail,
+        gbp_result=gbp_result,
+        web_result=web_result,
+        competitors_df=competitors_df,
+        rank_rows=rank_rows,
+        monthly_search_volume=monthly_search_volume,
+        dine_in_aov=dine_in_aov,
+        delivery_aov=delivery_aov,
+        menus_payload=menus_payload,
+    )
 
     st.markdown("## 🔟 免费获取完整诊断报告 & 1 对 1 咨询")
 